@@ -0,0 +1,121 @@
+from array import array
+
+# Array-backed node storage. Instead of one Python object per node, an arena
+# keeps every node's key, child indices, subtree size and height in parallel
+# typed arrays (-1 means "no child"). Slots freed by deletes go on a free list
+# and are reused by the next insert.
+#
+# The tree classes still work with node objects: ArenaNode is a two-slot
+# handle that reads and writes the arrays, created on demand and thrown away
+# after use. Memory per node drops to a few bytes of array space, at the cost
+# of slower attribute access.
+
+NO_NODE = -1
+
+
+class ArenaNode:
+    __slots__ = ("arena", "index")
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+
+    def __eq__(self, other):
+        if not isinstance(other, ArenaNode):
+            return NotImplemented
+        return self.index == other.index and self.arena is other.arena
+
+    def __hash__(self):
+        return hash(self.index)
+
+    @property
+    def key(self):
+        return self.arena.keys[self.index]
+
+    @key.setter
+    def key(self, value):
+        self.arena.keys[self.index] = value
+
+    @property
+    def left(self):
+        return self.arena.node(self.arena.lefts[self.index])
+
+    @left.setter
+    def left(self, node):
+        self.arena.lefts[self.index] = node.index if node else NO_NODE
+
+    @property
+    def right(self):
+        return self.arena.node(self.arena.rights[self.index])
+
+    @right.setter
+    def right(self, node):
+        self.arena.rights[self.index] = node.index if node else NO_NODE
+
+    @property
+    def size(self):
+        return self.arena.sizes[self.index]
+
+    @size.setter
+    def size(self, value):
+        self.arena.sizes[self.index] = value
+
+    @property
+    def height(self):
+        return self.arena.heights[self.index]
+
+    @height.setter
+    def height(self, value):
+        self.arena.heights[self.index] = value
+
+
+class NodeArena:
+    # key_typecode is an array module typecode; the default stores 64-bit
+    # integer keys. Heights get four bytes because an unbalanced BST can be
+    # as deep as it has keys.
+    def __init__(self, key_typecode="q"):
+        self.key_typecode = key_typecode
+        self.clear()
+
+    def clear(self):
+        self.keys = array(self.key_typecode)
+        self.lefts = array("i")
+        self.rights = array("i")
+        self.sizes = array("i")
+        self.heights = array("i")
+        self.free_list = array("i")
+
+    def __len__(self):
+        return len(self.keys) - len(self.free_list)
+
+    def node(self, index):
+        return ArenaNode(self, index) if index != NO_NODE else None
+
+    def new_node(self, key):
+        if self.free_list:
+            index = self.free_list.pop()
+            self.keys[index] = key
+            self.lefts[index] = NO_NODE
+            self.rights[index] = NO_NODE
+            self.sizes[index] = 1
+            self.heights[index] = 1
+        else:
+            index = len(self.keys)
+            self.keys.append(key)
+            self.lefts.append(NO_NODE)
+            self.rights.append(NO_NODE)
+            self.sizes.append(1)
+            self.heights.append(1)
+        return ArenaNode(self, index)
+
+    def free(self, node):
+        self.free_list.append(node.index)
+
+    def check_keys(self, keys):
+        # Raises TypeError for keys the key array can't hold (floats or
+        # strings in an integer arena, integers beyond 64 bits), so trees can
+        # reject them before changing anything
+        try:
+            array(self.key_typecode, keys)
+        except (TypeError, OverflowError):
+            raise TypeError("Key can't be stored in this arena") from None
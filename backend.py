@@ -1,338 +1,364 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g
 from flask_cors import CORS
+import atexit
 import json
+import logging
 import os
+from contextlib import contextmanager
+from itertools import chain, islice
+
+from engines import ENGINES
+from events import TooManySubscribers
+from metrics import PhaseTimer, RequestMetrics, render_tree_metrics
+from sessions import InvalidTreeId, TreeNotFound, TreeRegistry
+from trees import find_node, window
 
 app = Flask(__name__)
 CORS(app)  # This enables cross-origin requests
 
-# Tree data structure classes
-class TreeNode:
-    def __init__(self, key):
-        self.key = key
-        self.left = None
-        self.right = None
-        self.height = 1  # For AVL tree
-
-class BinarySearchTree:
-    def __init__(self):
-        self.root = None
-        self.inserted_keys = []
-    
-    def insert(self, key):
-        if key in self.inserted_keys:
-            return False  # Prevent duplicate keys
-            
-        self.root = self._insert_recursive(self.root, key)
-        self.inserted_keys.append(key)
-        return True
-    
-    def _insert_recursive(self, root, key):
-        if not root:
-            return TreeNode(key)
-        
-        if key < root.key:
-            root.left = self._insert_recursive(root.left, key)
-        elif key > root.key:
-            root.right = self._insert_recursive(root.right, key)
-        
-        return root
-    
-    def search(self, key):
-        return self._search_recursive(self.root, key)
-    
-    def _search_recursive(self, root, key, level=0, parent=None, path=None):
-        if path is None:
-            path = []
-        if not root:
-            return {"found": False, "key": key, "path": path}
-
-        path.append(root.key)
-
-        if key == root.key:
-            return {
-                "found": True,
-                "key": key,
-                "level": level,
-                "parent": parent.key if parent else "None",
-                "path": path
-            }
-
-        if key < root.key:
-            return self._search_recursive(root.left, key, level + 1, root, path)
-        return self._search_recursive(root.right, key, level + 1, root, path)
-    
-    def delete(self, key):
-        if key not in self.inserted_keys:
-            return False
-            
-        self.root = self._delete_recursive(self.root, key)
-        if key in self.inserted_keys:
-            self.inserted_keys.remove(key)
-        return True
-    
-    def _delete_recursive(self, root, key):
-        if not root:
-            return None
-        
-        if key < root.key:
-            root.left = self._delete_recursive(root.left, key)
-        elif key > root.key:
-            root.right = self._delete_recursive(root.right, key)
-        else:
-            # Node with only one child or no child
-            if not root.left:
-                return root.right
-            elif not root.right:
-                return root.left
-            
-            # Node with two children
-            successor = self._find_min(root.right)
-            root.key = successor.key
-            root.right = self._delete_recursive(root.right, successor.key)
-        
-        return root
-    
-    def _find_min(self, root):
-        current = root
-        while current.left:
-            current = current.left
-        return current
-    
-    def to_dict(self):
-        return self._to_dict_recursive(self.root)
-    
-    def _to_dict_recursive(self, node):
-        if not node:
-            return None
-        
-        return {
-            "key": node.key,
-            "left": self._to_dict_recursive(node.left),
-            "right": self._to_dict_recursive(node.right)
-        }
-
-class AVLNode:
-    def __init__(self, key):
-        self.key = key
-        self.left = None
-        self.right = None
-        self.height = 1
-
-class AVLTree:
-    def __init__(self):
-        self.root = None
-        self.inserted_keys = []
-
-    def height(self, node):
-        return node.height if node else 0
-
-    def get_balance(self, node):
-        return self.height(node.left) - self.height(node.right) if node else 0
-
-    def right_rotate(self, y):
-        x = y.left
-        T2 = x.right
-
-        x.right = y
-        y.left = T2
-
-        y.height = 1 + max(self.height(y.left), self.height(y.right))
-        x.height = 1 + max(self.height(x.left), self.height(x.right))
-
-        return x
-
-    def left_rotate(self, x):
-        y = x.right
-        T2 = y.left
-
-        y.left = x
-        x.right = T2
-
-        x.height = 1 + max(self.height(x.left), self.height(x.right))
-        y.height = 1 + max(self.height(y.left), self.height(y.right))
-
-        return y
-
-    def insert(self, key):
-        if key in self.inserted_keys:
-            return False  # Prevent duplicate keys
-        self.root = self._insert(self.root, key)
-        self.inserted_keys.append(key)
-        return True
-
-    def _insert(self, node, key):
-        if not node:
-            return AVLNode(key)
-
-        if key < node.key:
-            node.left = self._insert(node.left, key)
-        elif key > node.key:
-            node.right = self._insert(node.right, key)
-        else:
-            return node  # No duplicates
-
-        node.height = 1 + max(self.height(node.left), self.height(node.right))
-
-        balance = self.get_balance(node)
-
-        # LL
-        if balance > 1 and key < node.left.key:
-            return self.right_rotate(node)
-
-        # RR
-        if balance < -1 and key > node.right.key:
-            return self.left_rotate(node)
-
-        # LR
-        if balance > 1 and key > node.left.key:
-            node.left = self.left_rotate(node.left)
-            return self.right_rotate(node)
-
-        # RL
-        if balance < -1 and key < node.right.key:
-            node.right = self.right_rotate(node.right)
-            return self.left_rotate(node)
-
-        return node
-
-    def search(self, key):
-        return self._search_recursive(self.root, key)
-
-    def _search_recursive(self, root, key, level=0, parent=None, path=None):
-        if path is None:
-            path = []
-        if not root:
-            return {"found": False, "key": key, "path": path}
-
-        path.append(root.key)
-
-        if key == root.key:
-            return {
-                "found": True,
-                "key": key,
-                "level": level,
-                "parent": parent.key if parent else "None",
-                "path": path
-            }
-
-        if key < root.key:
-            return self._search_recursive(root.left, key, level + 1, root, path)
-        return self._search_recursive(root.right, key, level + 1, root, path)
-
-        
-    def delete(self, key):
-        if key not in self.inserted_keys:
-            return False
-        self.root = self._delete(self.root, key)
-        self.inserted_keys.remove(key)
-        return True
-
-    def _delete(self, node, key):
-        if not node:
-            return node
-
-        if key < node.key:
-            node.left = self._delete(node.left, key)
-        elif key > node.key:
-            node.right = self._delete(node.right, key)
-        else:
-            if not node.left:
-                return node.right
-            elif not node.right:
-                return node.left
-
-            temp = self._find_min(node.right)
-            node.key = temp.key
-            node.right = self._delete(node.right, temp.key)
-
-        node.height = 1 + max(self.height(node.left), self.height(node.right))
-
-        balance = self.get_balance(node)
-
-        # LL
-        if balance > 1 and self.get_balance(node.left) >= 0:
-            return self.right_rotate(node)
-
-        # RR
-        if balance < -1 and self.get_balance(node.right) <= 0:
-            return self.left_rotate(node)
-
-        # LR
-        if balance > 1 and self.get_balance(node.left) < 0:
-            node.left = self.left_rotate(node.left)
-            return self.right_rotate(node)
-
-        # RL
-        if balance < -1 and self.get_balance(node.right) > 0:
-            node.right = self.right_rotate(node.right)
-            return self.left_rotate(node)
-
-        return node
-
-    def _find_min(self, node):
-        current = node
-        while current.left:
-            current = current.left
-        return current
-
-    def to_dict(self):
-        return self._to_dict_recursive(self.root)
-
-    def _to_dict_recursive(self, node):
-        if not node:
-            return None
-        
-        return {
-            "key": node.key,
-            "left": self._to_dict_recursive(node.left),
-            "right": self._to_dict_recursive(node.right)
-        }
-
-# Global tree instance
-current_tree = BinarySearchTree()
-tree_type = "bst"
-
-# Ensure tree.json file exists
-def save_tree_state():
-    tree_data = {
-        "type": tree_type,
-        "insertedKeys": current_tree.inserted_keys,
-        "tree": current_tree.to_dict()
+# Tree types are the engines registered in engines.py: "bst", "avl",
+# "redblack", "treap" and "btree".
+
+# Path-copying trees (see persistent.py) let /search and /traverse read a
+# pinned root without locking while writers publish new versions. Only the
+# bst and avl engines have them; the others always update in place.
+USE_PERSISTENT_TREES = True
+
+# Store nodes in typed arrays (see arena.py) instead of one object per node.
+# Uses far less memory for large integer-keyed trees, but is slower. Arena
+# nodes are updated in place, so this turns off persistent trees. Only the
+# bst and avl engines support it.
+USE_NODE_ARENA = False
+
+# Keys per B-tree node are at most BTREE_ORDER - 1
+BTREE_ORDER = 32
+
+ENGINE_OPTIONS = {
+    "btree": {"order": BTREE_ORDER}
+}
+
+def create_tree(new_type):
+    tree = ENGINES[new_type].create(persistent=USE_PERSISTENT_TREES, arena=USE_NODE_ARENA,
+                                    **ENGINE_OPTIONS.get(new_type, {}))
+    tree.journal = []
+    return tree
+
+# Operation log settings: fsync every LOG_SYNC_EVERY records and fold a
+# tree's log into its snapshot once it reaches LOG_COMPACT_BYTES or
+# LOG_COMPACT_INTERVAL seconds have passed since the last compaction
+LOG_SYNC_EVERY = 16
+LOG_COMPACT_BYTES = 4 * 1024 * 1024
+LOG_COMPACT_INTERVAL = 60.0
+
+# Trees are named by a tree_id on every request; requests without one use
+# DEFAULT_TREE_ID, which is stored in tree.json (tree.snap for binary
+# snapshots). Others live in TREE_DATA_DIR.
+# Loaded trees are evicted to disk, least recently used first, once they are
+# estimated to use more than TREE_MEMORY_BUDGET bytes or have been idle for
+# TREE_IDLE_TIMEOUT seconds.
+DEFAULT_TREE_ID = "default"
+TREE_DATA_DIR = "trees"
+TREE_MEMORY_BUDGET = 512 * 1024 * 1024
+TREE_BYTES_PER_KEY = 150
+TREE_IDLE_TIMEOUT = 30 * 60.0
+
+# Number of versions each tree keeps for /tree/delta
+DELTA_HISTORY = 500
+
+# /events: each subscriber may fall EVENTS_MAX_PENDING versions behind before
+# it is sent a snapshot instead, a tree accepts at most EVENTS_MAX_SUBSCRIBERS
+# streams, and idle streams get a comment every EVENTS_HEARTBEAT seconds so
+# proxies keep them open and closed connections are noticed
+EVENTS_MAX_PENDING = 256
+EVENTS_MAX_SUBSCRIBERS = 100
+EVENTS_HEARTBEAT = 15.0
+
+# "json" or "binary" (see snapshot.py). Binary snapshots are smaller, load
+# through mmap and keep the tree's exact shape across restarts; existing
+# JSON snapshots can be converted with "python snapshot.py to-binary".
+SNAPSHOT_FORMAT = "json"
+
+registry = TreeRegistry(
+    create_tree,
+    ENGINES,
+    data_dir=TREE_DATA_DIR,
+    default_tree_id=DEFAULT_TREE_ID,
+    memory_budget=TREE_MEMORY_BUDGET,
+    bytes_per_key=TREE_BYTES_PER_KEY,
+    idle_timeout=TREE_IDLE_TIMEOUT,
+    delta_history=DELTA_HISTORY,
+    default_paths=("tree.snap" if SNAPSHOT_FORMAT == "binary" else "tree.json", "tree.log"),
+    snapshot_format=SNAPSHOT_FORMAT,
+    event_settings={
+        "max_pending": EVENTS_MAX_PENDING,
+        "max_subscribers": EVENTS_MAX_SUBSCRIBERS
+    },
+    log_settings={
+        "sync_every": LOG_SYNC_EVERY,
+        "compact_bytes": LOG_COMPACT_BYTES,
+        "compact_interval": LOG_COMPACT_INTERVAL
     }
-    
-    with open('tree.json', 'w') as f:
-        json.dump(tree_data, f)
-
-# Initialize tree.json if it doesn't exist
-if not os.path.exists('tree.json'):
-    save_tree_state()
+)
+
+# Loaded trees are compacted to disk when the server exits
+atexit.register(registry.close)
+
+# Per-endpoint latency, split into the "tree", "io" (operation log) and
+# "serialization" phases each handler marks; "total" covers the whole request
+# except the body of streamed responses
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_registry():
+    # Starts background compaction and eviction with the first request
+    registry.start()
+
+@app.before_request
+def start_request_timer():
+    g.timer = PhaseTimer()
+
+@app.after_request
+def record_request_metrics(response):
+    timer = g.get('timer')
+    rule = request.url_rule
+    if timer is not None and rule is not None and rule.rule != '/metrics':
+        request_metrics.observe(rule.rule, timer)
+    return response
+
+def phase(name):
+    return g.timer.phase(name)
+
+@app.errorhandler(InvalidTreeId)
+def invalid_tree_id(error):
+    return jsonify({"success": False, "error": str(error)})
+
+@app.errorhandler(TreeNotFound)
+def tree_not_found(error):
+    return jsonify({"success": False, "error": str(error)})
+
+def request_tree_id():
+    data = request.get_json(silent=True) or {}
+    return data.get('tree_id') or request.args.get('tree_id')
+
+@contextmanager
+def reading(session):
+    # Persistent trees are read without the lock: a read takes tree.root once
+    # and later writes never touch the nodes under it. The other engines, and
+    # any tree with USE_NODE_ARENA, change nodes in place and are read under
+    # the lock so a read can't see a half-rotated tree.
+    tree = session.tree
+    if tree.persistent:
+        yield tree
+    else:
+        with session.lock:
+            yield session.tree
+
+def pin_keys(tree, keys):
+    # Keys streamed after the request returns. A persistent tree is walked
+    # lazily from the root the walk started at; its first key is taken now so
+    # bounds that can't be compared fail before a 200 has been sent. In-place
+    # trees are read whole, while the caller still holds the lock.
+    if tree.persistent:
+        first = list(islice(keys, 1))
+        return chain(first, keys)
+    return iter(list(keys))
 
 # API Routes
 @app.route('/tree.json')
 def get_tree():
-    # Serve the tree.json file directly
-    return send_from_directory('.', 'tree.json')
+    # Rendered from memory: the snapshot on disk is only updated periodically
+    with registry.use(request_tree_id()) as session:
+        with session.lock, phase("serialization"):
+            state = session.render_state(epoch=session.epoch, version=session.version)
+    return app.response_class(state, mimetype='application/json')
+
+@app.route('/layout')
+def get_layout():
+    # Node coordinates for the current version, so the browser only draws.
+    # since and epoch name the layout the client already has; it then gets
+    # only the nodes that changed, plus the keys removed, when the backend
+    # still has them.
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch')
+    with registry.use(request_tree_id()) as session, phase("serialization"):
+        layout = session.render_layout(since if epoch == session.epoch else None)
+    if layout is None:
+        return jsonify({"success": False, "error": "Layout is only available for binary trees"})
+    return app.response_class(layout, mimetype='application/json')
+
+# /tree/window returns at most this many levels below its root per request
+WINDOW_DEFAULT_DEPTH = 4
+WINDOW_MAX_DEPTH = 10
+
+@app.route('/tree/window')
+def get_tree_window():
+    # A depth-limited piece of the tree for trees too large to ship whole.
+    # Without root it starts at the tree's root; truncated children are
+    # expanded by asking again with root set to their key, JSON-encoded like
+    # the keys /insert takes.
+    depth = request.args.get('depth', WINDOW_DEFAULT_DEPTH, type=int)
+    root_key = None
+    if 'root' in request.args:
+        try:
+            root_key = json.loads(request.args['root'])
+        except ValueError:
+            pass
+        if root_key is None:
+            return jsonify({"success": False, "error": "Invalid root"})
+
+    if depth < 0:
+        return jsonify({"success": False, "error": "Invalid depth"})
+    depth = min(depth, WINDOW_MAX_DEPTH)
+
+    with registry.use(request_tree_id()) as session:
+        with session.lock:
+            if not session.tree.binary:
+                return jsonify({"success": False, "error": "Windows are only available for binary trees"})
+            root = session.tree.root
+            response = {"success": True, "epoch": session.epoch, "version": session.version}
+            if not session.tree.persistent:
+                return window_response(root, root_key, depth, response)
+
+    # A persistent tree's window is built outside the lock from the pinned root
+    return window_response(root, root_key, depth, response)
+
+def window_response(root, root_key, depth, response):
+    if root_key is not None:
+        try:
+            root = find_node(root, root_key)
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid root"})
+        if not root:
+            return jsonify({"success": False, "error": "Key not found"})
+
+    response["depth"] = depth
+    response["tree"] = window(root, depth)
+    return jsonify(response)
+
+@app.route('/tree/delta')
+def get_tree_delta():
+    since = request.args.get('since', type=int)
+
+    with registry.use(request_tree_id()) as session:
+        changes = session.changes_since(since)
+        response = {"epoch": session.epoch, "version": session.version}
+
+    # Clients that are too far behind (or ahead, after a restart) have to
+    # fall back to a full /tree.json fetch
+    response["full"] = changes is None
+    if changes is not None:
+        response["changes"] = changes
+    return jsonify(response)
+
+def sse_message(event, data, event_id=None):
+    # data must be a single line, which JSON without indentation is
+    lines = ["id: " + event_id] if event_id else []
+    lines.append("event: " + event)
+    lines.append("data: " + data)
+    return "\n".join(lines) + "\n\n"
+
+def snapshot_message(session):
+    with session.lock:
+        version = session.version
+        state = session.render_state(epoch=session.epoch, version=version)
+    return version, sse_message("snapshot", state, f"{session.epoch}:{version}")
+
+def changes_message(session, since, version, changes):
+    data = json.dumps({"since": since, "version": version, "changes": changes})
+    return sse_message("changes", data, f"{session.epoch}:{version}")
+
+def stream_events(tree_id, last_event_id):
+    # Event ids are "epoch:version", so a reconnecting EventSource resumes
+    # from the changes it missed; anyone else starts from a snapshot
+    epoch, _, since = (last_event_id or "").partition(":")
+    since = int(since) if since.isdigit() else None
+
+    # The session stays in use, and so loaded, while someone is watching it
+    with registry.use(tree_id) as session:
+        subscription, changes, version = session.subscribe(epoch, since)
+        try:
+            if changes is None:
+                version, message = snapshot_message(session)
+                yield message
+            else:
+                yield changes_message(session, since, version, changes)
+
+            while not subscription.closed:
+                resync, batch = subscription.wait(EVENTS_HEARTBEAT)
+                batch = [entry for entry in batch if entry[1] > version]
+                # bulk_load rebuilds the whole tree, so it's sent as a snapshot
+                # too, like the versions a slow subscriber lost
+                if resync or any(change["op"] == "rebuild"
+                                 for _, _, entry_changes in batch for change in entry_changes):
+                    version, message = snapshot_message(session)
+                    yield message
+                elif batch:
+                    yield "".join(changes_message(session, *entry) for entry in batch)
+                    version = batch[-1][1]
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+
+def resume_stream(first, rest):
+    try:
+        yield first
+        yield from rest
+    finally:
+        rest.close()
+
+@app.route('/events')
+def get_events():
+    # Server-sent events: a "snapshot" event with the /tree.json document,
+    # then one "changes" event per version with the same changes /tree/delta
+    # returns, plus the version it applies to ("since")
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    events = stream_events(request_tree_id(), last_event_id)
+    try:
+        # Runs up to the catch-up message, so an unknown tree or a full
+        # subscriber list is reported as a normal response
+        first = next(events)
+    except TooManySubscribers as error:
+        return jsonify({"success": False, "error": str(error)}), 503
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return app.response_class(resume_stream(first, events), mimetype='text/event-stream',
+                              headers=headers)
 
 @app.route('/initialize', methods=['POST'])
 def initialize_tree():
-    global current_tree, tree_type
-
     data = request.json
     new_type = data.get('type', 'bst').lower()
 
-    if new_type == 'bst':
-        current_tree = BinarySearchTree()
-    elif new_type == 'avl':
-        current_tree = AVLTree()
-    else:
+    if new_type not in ENGINES:
         return jsonify({"success": False, "error": "Invalid tree type"})
 
-    tree_type = new_type  # ✅ update the global AFTER successful type check
-    save_tree_state()     # ✅ save the correct structure and type
+    with registry.use(data.get('tree_id'), create=True) as session:
+        with session.lock:
+            with phase("tree"):
+                session.reset(new_type)  # ✅ only replace the tree AFTER a successful type check
     return jsonify({"success": True})
 
 
+def traced(tree, enabled, operation, key):
+    # Runs operation(key) and returns its result along with the steps the
+    # tree traced (see BinarySearchTree.trace), or None when not enabled
+    if not enabled:
+        return operation(key), None
+    tree.trace = []
+    try:
+        return operation(key), tree.trace
+    finally:
+        tree.trace = None
+
+def success_response(trace):
+    response = {"success": True}
+    if trace is not None:
+        response["trace"] = trace
+    return jsonify(response)
+
+# /insert and /delete take "trace": true to return the steps the operation
+# took, so the UI can animate it without comparing tree versions
 @app.route('/insert', methods=['POST'])
 def insert_key():
     data = request.json
@@ -341,14 +367,47 @@ def insert_key():
     if key is None:
         return jsonify({"success": False, "error": "No key provided"})
     
-    result = current_tree.insert(key)
-    save_tree_state()
+    with registry.use(data.get('tree_id'), create=True) as session:
+        with session.lock:
+            with phase("tree"):
+                try:
+                    result, trace = traced(session.tree, data.get('trace'), session.tree.insert, key)
+                except TypeError:
+                    return jsonify({"success": False, "error": "Invalid key"})
+            if result:
+                with phase("io"):
+                    session.commit("insert", key=key)
     
     if result:
-        return jsonify({"success": True})
+        return success_response(trace)
     else:
         return jsonify({"success": False, "error": "Key already exists"})
 
+@app.route('/bulk_insert', methods=['POST'])
+def bulk_insert_keys():
+    data = request.json
+    keys = data.get('keys')
+
+    if not isinstance(keys, list) or not keys:
+        return jsonify({"success": False, "error": "No keys provided"})
+
+    with registry.use(data.get('tree_id'), create=True) as session:
+        with session.lock:
+            with phase("tree"):
+                try:
+                    inserted = session.tree.bulk_load(keys)
+                except TypeError:
+                    return jsonify({"success": False, "error": "Keys can't be compared"})
+            if inserted:
+                with phase("io"):
+                    session.commit("bulk_insert", keys=inserted)
+
+    return jsonify({
+        "success": True,
+        "inserted": len(inserted),
+        "skipped": len(keys) - len(inserted)
+    })
+
 @app.route('/delete', methods=['POST'])
 def delete_key():
     data = request.json
@@ -357,14 +416,79 @@ def delete_key():
     if key is None:
         return jsonify({"success": False, "error": "No key provided"})
     
-    result = current_tree.delete(key)
-    save_tree_state()
+    with registry.use(data.get('tree_id')) as session:
+        with session.lock:
+            with phase("tree"):
+                try:
+                    result, trace = traced(session.tree, data.get('trace'), session.tree.delete, key)
+                except TypeError:
+                    return jsonify({"success": False, "error": "Invalid key"})
+            if result:
+                with phase("io"):
+                    session.commit("delete", key=key)
     
     if result:
-        return jsonify({"success": True})
+        return success_response(trace)
     else:
         return jsonify({"success": False, "error": "Key not found"})
 
+@app.route('/delete_range', methods=['POST'])
+def delete_key_range():
+    # Removes every key in [lo, hi]. AVL trees cut the range out with split
+    # and join (see AVLTree.delete_range) instead of deleting key by key.
+    data = request.json
+    lo = data.get('lo')
+    hi = data.get('hi')
+
+    if lo is None or hi is None:
+        return jsonify({"success": False, "error": "Range needs lo and hi"})
+
+    with registry.use(data.get('tree_id')) as session:
+        with session.lock:
+            with phase("tree"):
+                try:
+                    removed = session.tree.delete_range(lo, hi)
+                except TypeError:
+                    return jsonify({"success": False, "error": "Invalid range"})
+            if removed:
+                with phase("io"):
+                    session.commit("delete_range", lo=lo, hi=hi)
+
+    return jsonify({"success": True, "deleted": len(removed)})
+
+@app.route('/merge', methods=['POST'])
+def merge_trees():
+    # Adds every key of the tree named by source to tree_id; source is left
+    # as it is. The locks are taken one after the other, never together, so
+    # two merges in opposite directions can't deadlock.
+    data = request.json
+    source_id = data.get('source')
+
+    if not source_id:
+        return jsonify({"success": False, "error": "No source tree provided"})
+
+    # A source that was never written is an error rather than an empty tree,
+    # so a misspelled name doesn't look like a merge of nothing
+    try:
+        with registry.use(source_id) as source:
+            with source.lock, phase("tree"):
+                keys = list(source.tree.traverse("inorder"))
+    except TreeNotFound:
+        return jsonify({"success": False, "error": "Source tree not found"})
+
+    with registry.use(data.get('tree_id'), create=True) as session:
+        with session.lock:
+            with phase("tree"):
+                try:
+                    added = session.tree.union(keys)
+                except TypeError:
+                    return jsonify({"success": False, "error": "Keys can't be compared"})
+            if added:
+                with phase("io"):
+                    session.commit("merge", keys=added)
+
+    return jsonify({"success": True, "merged": len(added), "skipped": len(keys) - len(added)})
+
 @app.route('/search', methods=['POST'])
 def search_key():
     data = request.json
@@ -373,51 +497,286 @@ def search_key():
     if key is None:
         return jsonify({"success": False, "error": "No key provided"})
     
-    result = current_tree.search(key)
-    return jsonify(result)
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree, phase("tree"):
+        try:
+            result = tree.search(key)
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid key"})
+    with phase("serialization"):
+        return jsonify(result)
+
+# Largest number of keys accepted by one /search_many request
+MAX_SEARCH_MANY_KEYS = 100000
+
+@app.route('/search_many', methods=['POST'])
+def search_many_keys():
+    # Looks up a list of keys in one request. Answers come from a sorted
+    # array of the current version's keys (see searchindex.py) as parallel
+    # lists: found flags, ranks (keys smaller than each key) and depths
+    # (null for missing keys).
+    data = request.json
+    keys = data.get('keys')
+
+    if not isinstance(keys, list) or not keys:
+        return jsonify({"success": False, "error": "No keys provided"})
+    if len(keys) > MAX_SEARCH_MANY_KEYS:
+        return jsonify({"success": False, "error": "Too many keys"})
+
+    with registry.use(data.get('tree_id')) as session, phase("tree"):
+        index = session.search_index()
+        try:
+            found, ranks, depths = index.search_many(keys)
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid keys"})
+
+    with phase("serialization"):
+        return jsonify({"success": True, "version": index.version, "found": found,
+                        "ranks": ranks, "depths": depths})
+
+# Largest number of operations accepted by one /batch request
+MAX_BATCH_OPERATIONS = 10000
+BATCH_OPERATIONS = ("insert", "delete", "search")
+
+def check_batch(operations, keys, arena=None):
+    # Dry run of a batch against the key set alone: returns the error each
+    # operation would hit (None for success) without touching the tree.
+    # JSON keys that can be hashed are numbers or strings, which either
+    # compare with every other key of their kind or with none of them, so
+    # comparing each key with one reference key shows whether the tree
+    # could place it. Inserted keys must also fit the tree's arena, if any.
+    reference = next(iter(keys), None)
+    added, removed = set(), set()
+    errors = []
+    for operation in operations:
+        key = operation.get('key') if isinstance(operation, dict) else None
+        if key is None or operation.get('op') not in BATCH_OPERATIONS:
+            errors.append("Invalid operation")
+            continue
+
+        try:
+            if reference is None:
+                reference = key
+            key < reference
+            present = (key in keys or key in added) and key not in removed
+            if arena is not None and operation['op'] == 'insert':
+                arena.check_keys((key,))
+        except TypeError:
+            errors.append("Invalid key")
+            continue
+        if operation['op'] == 'insert':
+            if present:
+                errors.append("Key already exists")
+                continue
+            added.add(key)
+            removed.discard(key)
+        elif operation['op'] == 'delete':
+            if not present:
+                errors.append("Key not found")
+                continue
+            removed.add(key)
+            added.discard(key)
+        errors.append(None)
+    return errors
+
+def apply_batch_operation(tree, operation, trace_requested, applied):
+    # Runs one operation of a batch and returns its result; successful
+    # mutations are added to applied
+    key = operation.get('key') if isinstance(operation, dict) else None
+    op = operation.get('op') if isinstance(operation, dict) else None
+    if key is None or op not in BATCH_OPERATIONS:
+        return {"success": False, "error": "Invalid operation"}
+
+    try:
+        if op == 'search':
+            return dict(tree.search(key), success=True)
+        if op == 'insert':
+            done, trace = traced(tree, trace_requested, tree.insert, key)
+        else:
+            done, trace = traced(tree, trace_requested, tree.delete, key)
+    except TypeError:
+        # Keys that can't be compared fail before the tree changes
+        return {"success": False, "error": "Invalid key"}
+
+    if not done:
+        return {"success": False, "error": "Key already exists" if op == 'insert' else "Key not found"}
+    applied.append({"op": op, "key": key})
+    return {"success": True, "trace": trace} if trace_requested else {"success": True}
+
+@app.route('/batch', methods=['POST'])
+def batch_operations():
+    # Applies a list of {"op": "insert"|"delete"|"search", "key": ...} in
+    # order under one lock, logs the successful mutations as a single record
+    # and publishes them as one version. With "atomic": true nothing is
+    # applied unless every operation would succeed; with "trace": true each
+    # successful insert and delete result carries its trace.
+    data = request.json
+    operations = data.get('operations')
+    atomic = bool(data.get('atomic', False))
+    trace_requested = bool(data.get('trace', False))
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"success": False, "error": "No operations provided"})
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"success": False, "error": "Too many operations"})
+
+    results = []
+    applied = []
+    with registry.use(data.get('tree_id'), create=True) as session:
+        with session.lock:
+            tree = session.tree
+            if atomic:
+                errors = check_batch(operations, tree.inserted_keys, tree.arena)
+                if any(errors):
+                    results = [{"success": False, "error": error} if error else {"success": True}
+                               for error in errors]
+                    return jsonify({"success": False, "error": "Batch rejected", "results": results})
+
+            # Whatever was applied is logged and published even if a later
+            # operation raises, so the log never falls behind the tree
+            try:
+                with phase("tree"):
+                    for operation in operations:
+                        results.append(apply_batch_operation(tree, operation, trace_requested, applied))
+            finally:
+                if applied:
+                    with phase("io"):
+                        session.commit("batch", ops=applied)
+
+    with phase("serialization"):
+        return jsonify({"success": True, "applied": len(applied), "results": results})
+
+# Order statistics come from the subtree sizes kept in every node, so each of
+# these walks one root-to-leaf path instead of traversing the tree
+@app.route('/rank', methods=['POST'])
+def rank_key():
+    data = request.json
+    key = data.get('key')
 
-from collections import deque
+    if key is None:
+        return jsonify({"success": False, "error": "No key provided"})
 
-def inorder(node):
-    return inorder(node.left) + [node.key] + inorder(node.right) if node else []
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree:
+        try:
+            position = tree.rank(key)
+            found = key in tree.inserted_keys
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid key"})
+    return jsonify({"success": True, "key": key, "rank": position, "found": found})
 
-def preorder(node):
-    return [node.key] + preorder(node.left) + preorder(node.right) if node else []
+@app.route('/select', methods=['POST'])
+def select_key():
+    data = request.json
+    index = data.get('index')
 
-def postorder(node):
-    return postorder(node.left) + postorder(node.right) + [node.key] if node else []
+    if not isinstance(index, int) or isinstance(index, bool):
+        return jsonify({"success": False, "error": "Invalid index"})
 
-def level_order(node):
-    if not node:
-        return []
-    queue, result = deque([node]), []
-    while queue:
-        current = queue.popleft()
-        result.append(current.key)
-        if current.left:
-            queue.append(current.left)
-        if current.right:
-            queue.append(current.right)
-    return result
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree:
+        try:
+            key = tree.select(index)
+        except IndexError:
+            return jsonify({"success": False, "error": "Index out of range"})
+    return jsonify({"success": True, "index": index, "key": key})
 
+@app.route('/count_range', methods=['POST'])
+def count_keys_in_range():
+    data = request.json
+    lo = data.get('lo')
+    hi = data.get('hi')
+
+    if lo is None or hi is None:
+        return jsonify({"success": False, "error": "Range needs lo and hi"})
+
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree:
+        try:
+            count = tree.count_range(lo, hi)
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid range"})
+    return jsonify({"success": True, "lo": lo, "hi": hi, "count": count})
+
+# Keys per chunk when streaming /traverse results
+TRAVERSE_CHUNK = 1000
+
+def stream_traversal(keys, output_format, field="traversal"):
+    batch = list(islice(keys, TRAVERSE_CHUNK))
+
+    if output_format == 'ndjson':
+        while batch:
+            yield "".join(json.dumps(key) + "\n" for key in batch)
+            batch = list(islice(keys, TRAVERSE_CHUNK))
+        return
+
+    yield '{' + json.dumps(field) + ': ['
+    separator = ""
+    while batch:
+        yield separator + ", ".join(json.dumps(key) for key in batch)
+        separator = ", "
+        batch = list(islice(keys, TRAVERSE_CHUNK))
+    yield ']}'
 
 @app.route('/traverse', methods=['POST'])
 def traverse_tree():
     data = request.json
     traversal_type = data.get('type', 'inorder')
-    
-    result = []  
-    if traversal_type == 'inorder':
-        result = inorder(current_tree.root)
-    elif traversal_type == 'preorder':
-        result = preorder(current_tree.root)
-    elif traversal_type == 'postorder':
-        result = postorder(current_tree.root)
-    elif traversal_type == 'levelorder':
-        result = level_order(current_tree.root)
-
-    return jsonify({"traversal": result})
-
+    output_format = data.get('format', 'json')
+    offset = data.get('offset', 0)
+    limit = data.get('limit')
+
+    if not isinstance(offset, int) or offset < 0:
+        return jsonify({"success": False, "error": "Invalid offset"})
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        return jsonify({"success": False, "error": "Invalid limit"})
+
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree:
+        try:
+            keys = tree.traverse(traversal_type)
+        except KeyError:
+            keys = iter(())
+        keys = pin_keys(tree, islice(keys, offset, None if limit is None else offset + limit))
+
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    return app.response_class(stream_traversal(keys, output_format), mimetype=mimetype)
+
+@app.route('/range', methods=['POST'])
+def range_keys():
+    # Keys in [lo, hi], or with "after" instead of lo, the keys that follow
+    # it. Either bound may be left out. Large results are paged by passing
+    # the last key received as "after" in the next request.
+    data = request.json
+    lo = data.get('lo')
+    hi = data.get('hi')
+    after = data.get('after')
+    output_format = data.get('format', 'json')
+    limit = data.get('limit')
+
+    if lo is not None and after is not None:
+        return jsonify({"success": False, "error": "Use either lo or after, not both"})
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        return jsonify({"success": False, "error": "Invalid limit"})
+
+    with registry.use(data.get('tree_id')) as session, reading(session) as tree:
+        if after is not None:
+            keys = tree.key_range(after, hi, include_lo=False)
+        else:
+            keys = tree.key_range(lo, hi)
+        if limit is not None:
+            keys = islice(keys, limit)
+        try:
+            keys = pin_keys(tree, keys)
+        except TypeError:
+            return jsonify({"success": False, "error": "Invalid range"})
+
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    return app.response_class(stream_traversal(keys, output_format, "keys"), mimetype=mimetype)
+
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus text format. Tree series cover the trees currently loaded.
+    trees = [(session.tree_id, session.tree_type, session.tree)
+             for session in registry.sessions() if session.tree is not None]
+    lines = request_metrics.render() + render_tree_metrics(trees)
+    return app.response_class("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
 # Serve the HTML file
 @app.route('/')
@@ -425,6 +784,11 @@ def serve_ui():
     return send_from_directory('.', 'treeui.html')
 
 if __name__ == '__main__':
+    # The debug reloader runs this module in a watcher process as well; only
+    # the child that serves requests should own the tree logs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        registry.start()
+    logging.basicConfig(level=logging.INFO)
     print("Server running at http://127.0.0.1:5000")
     print("Open this URL in your browser to use the Tree Visualizer")
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,209 @@
+import argparse
+import bisect
+import functools
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from engines import ENGINES
+from oplog import OperationLog
+from sessions import TreeSession
+from trees import TRAVERSALS
+
+# Times every tree operation the backend relies on, for each tree engine, key
+# order and size. Each case prints one JSON line (or a table row) with the
+# time per operation in microseconds, so runs of different sizes line up.
+# Every case runs --repeat times on a fresh tree and keeps the fastest time
+# of each metric, which filters out most scheduling noise.
+#
+# --save-baseline writes the results to a file; --baseline compares a run
+# against such a file and exits with status 1 when any metric got slower by
+# more than --threshold (0.2 = 20%). Cases missing from either side are
+# ignored, so a quick run can be checked against a full baseline.
+
+# Every engine registered in engines.py, plus the path-copying variants
+TREES = {name: engine.tree_class for name, engine in ENGINES.items()}
+TREES.update({"persistent-" + name: engine.persistent_class
+              for name, engine in ENGINES.items() if engine.persistent_class})
+
+ORDERS = ("sorted", "reversed", "random", "zipfian")
+
+ZIPF_EXPONENT = 1.1
+
+
+def make_keys(order, size, rng):
+    keys = list(range(size))
+    if order == "reversed":
+        keys.reverse()
+    elif order == "random":
+        rng.shuffle(keys)
+    elif order == "zipfian":
+        # A stream of size draws where a few hot keys repeat often; repeats
+        # are rejected as duplicates just as they are by the backend
+        rng.shuffle(keys)
+        weights = itertools.accumulate(1 / rank ** ZIPF_EXPONENT for rank in range(1, size + 1))
+        cumulative = list(weights)
+        total = cumulative[-1]
+        keys = [keys[min(bisect.bisect(cumulative, rng.random() * total), size - 1)]
+                for _ in range(size)]
+    return keys
+
+
+def timed(run, count):
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    return round(elapsed / max(count, 1) * 1e6, 3)
+
+
+def run_case(tree_class, keys, rng):
+    # Microseconds per operation for one tree built from keys. tree_class is
+    # anything that returns a new empty tree.
+    metrics = {}
+    tree = tree_class()
+    distinct = list(dict.fromkeys(keys))
+
+    def insert_all():
+        for key in keys:
+            tree.insert(key)
+
+    def search_all():
+        for key in keys:
+            tree.search(key)
+
+    metrics["insert"] = timed(insert_all, len(keys))
+    metrics["search"] = timed(search_all, len(keys))
+    for name in TRAVERSALS:
+        metrics[name] = timed(lambda: sum(1 for _ in tree.traverse(name)), len(distinct))
+    metrics["to_dict"] = timed(tree.to_dict, len(distinct))
+    metrics["to_json"] = timed(tree.to_json, len(distinct))
+    metrics.update(measure_persistence(tree_class, tree, keys))
+
+    deletes = distinct[:]
+    rng.shuffle(deletes)
+
+    def delete_all():
+        for key in deletes:
+            tree.delete(key)
+
+    metrics["delete"] = timed(delete_all, len(deletes))
+    return metrics
+
+
+def measure_persistence(tree_class, tree, keys):
+    # Log appends, snapshot compaction and startup restore, through the same
+    # OperationLog and TreeSession code the backend uses
+    metrics = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = (os.path.join(directory, "tree.json"), os.path.join(directory, "tree.log"))
+
+        def open_session():
+            session = TreeSession("bench", OperationLog(*paths), lambda _: tree_class(),
+                                  ENGINES, delta_history=1)
+            session.ensure_open()
+            return session
+
+        session = open_session()
+        session.tree = tree
+
+        def append_all():
+            for key in keys:
+                session.oplog.append("insert", key=key)
+
+        metrics["log_append"] = timed(append_all, len(keys))
+        metrics["snapshot"] = timed(lambda: session.oplog.compact(session.render_snapshot),
+                                    len(tree.inserted_keys))
+        session.oplog.close()
+
+        restored = []
+        metrics["restore"] = timed(lambda: restored.append(open_session()), len(tree.inserted_keys))
+        restored[0].close()
+    return metrics
+
+
+def load_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def case_id(result):
+    return result["tree"], result["order"], result["size"]
+
+
+def find_regressions(results, baseline, threshold):
+    previous = {case_id(result): result["metrics"] for result in baseline}
+    regressions = []
+    for result in results:
+        old_metrics = previous.get(case_id(result))
+        if not old_metrics:
+            continue
+        for metric, value in result["metrics"].items():
+            old = old_metrics.get(metric)
+            if old and value > old * (1 + threshold):
+                regressions.append((case_id(result), metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tree operations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    # The persistent variants are included because they are what the backend runs by default
+    parser.add_argument("--trees", nargs="+", choices=sorted(TREES), default=list(TREES))
+    parser.add_argument("--btree-order", type=int, default=32, help="order of btree trees")
+    parser.add_argument("--orders", nargs="+", choices=ORDERS, default=list(ORDERS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-unbalanced", type=int, default=10_000,
+                        help="skip plain BSTs fed sorted or reversed keys above this size, "
+                             "since every insert walks the whole tree")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results against FILE")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for order in args.orders:
+            for name in args.trees:
+                if (name in ("bst", "persistent-bst") and order in ("sorted", "reversed")
+                        and size > args.max_unbalanced):
+                    continue
+
+                rng = random.Random(args.seed)
+                keys = make_keys(order, size, rng)
+                tree_class = TREES[name]
+                if name == "btree":
+                    tree_class = functools.partial(tree_class, order=args.btree_order)
+                runs = [run_case(tree_class, keys, rng) for _ in range(max(args.repeat, 1))]
+                metrics = {metric: min(run[metric] for run in runs) for metric in runs[0]}
+                result = {"tree": name, "order": order, "size": size, "metrics": metrics}
+                results.append(result)
+
+                if args.json:
+                    print(json.dumps(result), flush=True)
+                else:
+                    summary = " ".join(f"{metric}={value}" for metric, value in metrics.items())
+                    print(f"{name:<15} {order:<9} {size:>8} us/op: {summary}", flush=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if args.baseline:
+        regressions = find_regressions(results, load_results(args.baseline), args.threshold)
+        for (name, order, size), metric, old, new in regressions:
+            print(f"REGRESSION {name} {order} {size} {metric}: {old} -> {new} us/op",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+import heapq
+import json
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from trees import KeyIndex, TreeStats
+
+# B-tree: every node holds up to order - 1 sorted keys and, unless it is a
+# leaf, one more child than keys; all leaves are on the same level. Keys sit
+# next to each other in a Python list, so a lookup does one binary search
+# over a short contiguous list per level instead of following a pointer per
+# comparison, and the tree is only about log(n) / log(order) levels deep.
+# Inserts split full nodes on the way back up; deletes borrow from or merge
+# with a sibling when a node drops below half full.
+#
+# Nodes have no left/right, so the tree can't be drawn by the UI, /layout or
+# /tree/window, and saved B-trees are rebuilt from their keys. Clients can't
+# replay B-tree changes either: every mutation is journaled as a "rebuild".
+
+
+class BTreeNode:
+    __slots__ = ("keys", "children", "size")
+
+    def __init__(self, keys, children=None):
+        self.keys = keys
+        self.children = children or []  # Empty for leaves
+        self.size = len(keys)  # Number of keys in this subtree
+
+    def recount(self):
+        self.size = len(self.keys) + sum(child.size for child in self.children)
+
+
+class BTree:
+    persistent = False
+    binary = False
+    binary_snapshot = False
+    arena = None
+
+    def __init__(self, order=32):
+        if order < 3:
+            raise ValueError("B-tree order must be at least 3")
+        self.order = order
+        self.max_keys = order - 1
+        self.min_keys = (order + 1) // 2 - 1
+        self.root = None
+        self.inserted_keys = KeyIndex()
+        # Same roles as in BinarySearchTree
+        self.journal = None
+        self.trace = None
+        self.stats = TreeStats()
+
+    def _record(self, change):
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def _visit(self, nodes):
+        # Lookups binary-search each node's keys
+        self.stats.visit(len(nodes), sum(len(node.keys).bit_length() for node in nodes))
+
+    def insert(self, key):
+        if key in self.inserted_keys:
+            return False
+
+        self._insert_key(key)
+        self.inserted_keys.add(key)
+        self._record({"op": "rebuild"})
+        return True
+
+    def _insert_key(self, key):
+        if self.root is None:
+            self.root = BTreeNode([key])
+            return
+
+        path = []
+        node = self.root
+        while True:
+            index = bisect_left(node.keys, key)
+            path.append((node, index))
+            if not node.children:
+                break
+            node = node.children[index]
+        self._visit([node for node, _ in path])
+
+        # Sizes change only once the walk is done: a key that can't be
+        # compared raises from bisect_left before the tree is touched. The key
+        # is known to be new, so every node passed gains a key below it.
+        for passed, _ in path:
+            passed.size += 1
+        node.keys.insert(index, key)
+
+        # Split full nodes around their middle key, which moves up a level
+        path.pop()
+        while len(node.keys) > self.max_keys:
+            middle = len(node.keys) // 2
+            right = BTreeNode(node.keys[middle + 1:], node.children[middle + 1:])
+            right.recount()
+            separator = node.keys[middle]
+            del node.keys[middle:]
+            del node.children[middle + 1:]
+            node.size -= right.size + 1
+
+            if not path:
+                self.root = BTreeNode([separator], [node, right])
+                self.root.recount()
+                return
+            parent, index = path.pop()
+            parent.keys.insert(index, separator)
+            parent.children.insert(index + 1, right)
+            node = parent
+
+    def delete(self, key):
+        if key not in self.inserted_keys:
+            return False
+
+        self._delete_key(key)
+        self.inserted_keys.discard(key)
+        self._record({"op": "rebuild"})
+        return True
+
+    def _delete_key(self, key):
+        path = []
+        node = self.root
+        while node:
+            index = bisect_left(node.keys, key)
+            path.append((node, index))
+            if index < len(node.keys) and node.keys[index] == key:
+                break
+            node = node.children[index] if node.children else None
+        self._visit([node for node, _ in path])
+        if node is None:
+            return
+
+        # A key in an inner node is replaced by its predecessor, the last key
+        # of the rightmost leaf of its left subtree, which is removed instead
+        if node.children:
+            found, found_index = node, index
+            node = node.children[index]
+            while node.children:
+                path.append((node, len(node.children) - 1))
+                node = node.children[-1]
+            path.append((node, len(node.keys) - 1))
+            found.keys[found_index] = node.keys.pop()
+        else:
+            del node.keys[index]
+        for ancestor, _ in path:
+            ancestor.size -= 1
+
+        # Refill nodes that fell below min_keys from a sibling with keys to
+        # spare, or merge them with a sibling and the key between the two,
+        # which can leave the parent short in turn
+        path.pop()
+        while path and len(node.keys) < self.min_keys:
+            parent, index = path.pop()
+            left = parent.children[index - 1] if index > 0 else None
+            right = parent.children[index + 1] if index + 1 < len(parent.children) else None
+
+            if left and len(left.keys) > self.min_keys:
+                node.keys.insert(0, parent.keys[index - 1])
+                parent.keys[index - 1] = left.keys.pop()
+                moved = 1
+                if left.children:
+                    child = left.children.pop()
+                    node.children.insert(0, child)
+                    moved += child.size
+                left.size -= moved
+                node.size += moved
+                break
+
+            if right and len(right.keys) > self.min_keys:
+                node.keys.append(parent.keys[index])
+                parent.keys[index] = right.keys.pop(0)
+                moved = 1
+                if right.children:
+                    child = right.children.pop(0)
+                    node.children.append(child)
+                    moved += child.size
+                right.size -= moved
+                node.size += moved
+                break
+
+            if left:
+                left_node, right_node, separator = left, node, index - 1
+            else:
+                left_node, right_node, separator = node, right, index
+            left_node.keys.append(parent.keys.pop(separator))
+            left_node.keys.extend(right_node.keys)
+            left_node.children.extend(right_node.children)
+            left_node.size += 1 + right_node.size
+            del parent.children[separator + 1]
+            node = parent
+
+        if not self.root.keys:
+            self.root = self.root.children[0] if self.root.children else None
+
+    def bulk_load(self, keys):
+        # Like BinarySearchTree.bulk_load: merges the new keys with the
+        # existing ones and rebuilds the tree in one pass. Returns the keys
+        # that were added, in input order.
+        added = [key for key in dict.fromkeys(keys) if key not in self.inserted_keys]
+        if not added:
+            return []
+
+        merged = sorted(added)
+        if self.root:
+            merged = list(heapq.merge(self.key_range(), merged))
+        self.stats.visit(len(merged), 0)
+        self.root = self._build(merged)
+        self.inserted_keys.update(added)
+        self._record({"op": "rebuild"})
+        return added
+
+    def _build(self, sorted_keys):
+        # Builds the tree a level at a time from the leaves up. n keys make
+        # k = ceil((n + 1) / order) nodes with k - 1 keys left between them;
+        # those become the next level's keys, and its nodes take the nodes
+        # below in order, one more than they have keys. Keys are spread
+        # evenly, so every node is at least about half full.
+        keys = sorted_keys
+        below = None
+        while keys:
+            n = len(keys)
+            k = -(-(n + 1) // (self.max_keys + 1))
+            spread = n - (k - 1)
+            nodes = []
+            separators = []
+            start = child = 0
+            for j in range(k):
+                count = spread * (j + 1) // k - spread * j // k
+                node = BTreeNode(keys[start:start + count])
+                if below is not None:
+                    node.children = below[child:child + count + 1]
+                    child += count + 1
+                    node.recount()
+                nodes.append(node)
+                start += count
+                if j < k - 1:
+                    separators.append(keys[start])
+                    start += 1
+            if k == 1:
+                return nodes[0]
+            keys, below = separators, nodes
+        return None
+
+    def search(self, key):
+        # path lists the keys of every node passed; level counts nodes from
+        # 0 at the root
+        path = []
+        parent = None
+        node = self.root
+        while node:
+            path.append(list(node.keys))
+            index = bisect_left(node.keys, key)
+            if index < len(node.keys) and node.keys[index] == key:
+                self.stats.visit(len(path), sum(len(keys).bit_length() for keys in path))
+                return {
+                    "found": True,
+                    "key": key,
+                    "level": len(path) - 1,
+                    "parent": parent.keys if parent else "None",
+                    "path": path
+                }
+            parent = node
+            node = node.children[index] if node.children else None
+
+        self.stats.visit(len(path), sum(len(keys).bit_length() for keys in path))
+        return {"found": False, "key": key, "path": path}
+
+    # Order statistics from the subtree sizes, like the functions in trees.py;
+    # each level adds up the sizes of the children to the left of the path
+    def rank(self, key, inclusive=False):
+        count = 0
+        node = self.root
+        while node:
+            index = bisect_right(node.keys, key) if inclusive else bisect_left(node.keys, key)
+            count += index + sum(child.size for child in node.children[:index])
+            if not node.children:
+                break
+            if not inclusive and index < len(node.keys) and node.keys[index] == key:
+                return count + node.children[index].size
+            node = node.children[index]
+        return count
+
+    def select(self, index):
+        if index < 0 or index >= (self.root.size if self.root else 0):
+            raise IndexError("Index out of range")
+        node = self.root
+        while node.children:
+            for i, child in enumerate(node.children):
+                if index < child.size:
+                    node = child
+                    break
+                index -= child.size
+                if index == 0:
+                    return node.keys[i]
+                index -= 1
+        return node.keys[index]
+
+    def count_range(self, lo, hi):
+        if hi < lo:
+            return 0
+        return self.rank(hi, inclusive=True) - self.rank(lo)
+
+    def key_range(self, lo=None, hi=None, include_lo=True):
+        return key_range(self.root, lo, hi, include_lo)
+
+    def delete_range(self, lo, hi):
+        keys = list(self.key_range(lo, hi))
+        for key in keys:
+            self.delete(key)
+        return keys
+
+    def union(self, keys):
+        return self.bulk_load(keys)
+
+    def traverse(self, order):
+        # Raises KeyError for unknown orders, like BinarySearchTree.traverse
+        return BTREE_TRAVERSALS[order](self.root)
+
+    def key_depths(self):
+        # (key, depth) pairs in key order; every key of a node has its depth
+        stack = []
+        node, depth = self.root, 0
+        while node:
+            stack.append([node, 0, depth])
+            node, depth = (node.children[0] if node.children else None), depth + 1
+        while stack:
+            entry = stack[-1]
+            node, index, depth = entry
+            if index == len(node.keys):
+                stack.pop()
+                continue
+            yield node.keys[index], depth
+            entry[1] = index + 1
+            child, level = (node.children[index + 1] if node.children else None), depth + 1
+            while child:
+                stack.append([child, 0, level])
+                child, level = (child.children[0] if child.children else None), level + 1
+
+    def tree_height(self):
+        height = 0
+        node = self.root
+        while node:
+            height += 1
+            node = node.children[0] if node.children else None
+        return height
+
+    def to_dict(self):
+        root = self.root
+        if not root:
+            return None
+
+        result = {"keys": list(root.keys), "children": []}
+        stack = [(root, result)]
+        while stack:
+            node, data = stack.pop()
+            for child in node.children:
+                child_data = {"keys": list(child.keys), "children": []}
+                data["children"].append(child_data)
+                stack.append((child, child_data))
+        return result
+
+    def to_json(self):
+        # A B-tree is only log(n) / log(order) levels deep, so the json
+        # encoder's recursion is no concern here
+        return json.dumps(self.to_dict())
+
+
+def key_range(node, lo=None, hi=None, include_lo=True):
+    # Same bounds as trees.key_range(). The stack holds, for every node on
+    # the current path, the index of its next key to yield.
+    stack = []
+    while node:
+        if lo is None:
+            index = 0
+        else:
+            index = bisect_left(node.keys, lo) if include_lo else bisect_right(node.keys, lo)
+        stack.append([node, index])
+        node = node.children[index] if node.children else None
+
+    while stack:
+        entry = stack[-1]
+        node, index = entry
+        if index == len(node.keys):
+            stack.pop()
+            continue
+        key = node.keys[index]
+        if hi is not None and key > hi:
+            return
+        yield key
+        entry[1] = index + 1
+        child = node.children[index + 1] if node.children else None
+        while child:
+            stack.append([child, 0])
+            child = child.children[0] if child.children else None
+
+def inorder(node):
+    return key_range(node)
+
+def preorder(node):
+    # A node's keys, then its subtrees left to right
+    stack = [node] if node else []
+    while stack:
+        node = stack.pop()
+        yield from node.keys
+        stack.extend(reversed(node.children))
+
+def postorder(node):
+    # A node's subtrees left to right, then its keys
+    stack = [(node, 0)] if node else []
+    while stack:
+        node, index = stack.pop()
+        if index < len(node.children):
+            stack.append((node, index + 1))
+            stack.append((node.children[index], 0))
+        else:
+            yield from node.keys
+
+def level_order(node):
+    queue = deque([node]) if node else deque()
+    while queue:
+        node = queue.popleft()
+        yield from node.keys
+        queue.extend(node.children)
+
+BTREE_TRAVERSALS = {
+    "inorder": inorder,
+    "preorder": preorder,
+    "postorder": postorder,
+    "levelorder": level_order
+}
@@ -0,0 +1,54 @@
+from arena import NodeArena
+from btree import BTree
+from persistent import PersistentBST, PersistentAVLTree
+from redblack import RedBlackTree
+from trees import BinarySearchTree, AVLTree
+from treap import Treap
+
+# Registry of the tree engines /initialize can create, by type name. Every
+# engine's tree offers the same interface:
+#
+#   insert(key), delete(key), bulk_load(keys), search(key)
+#   rank(key), select(index), count_range(lo, hi), key_range(lo, hi)
+#   delete_range(lo, hi), union(keys)
+#   traverse(order)   lazy "inorder", "preorder", "postorder" or "levelorder"
+#   key_depths()      (key, depth) pairs in key order
+#   tree_height(), to_dict(), to_json()
+#
+# plus the inserted_keys, stats, journal and trace attributes. Trees whose
+# binary attribute is true are made of key/left/right nodes that /layout,
+# /tree/window and the UI can draw.
+
+
+class Engine:
+    def __init__(self, name, label, tree_class, persistent_class=None, arena=False):
+        self.name = name
+        self.label = label
+        self.tree_class = tree_class
+        # Path-copying variant (see persistent.py), if there is one
+        self.persistent_class = persistent_class
+        # Whether tree_class can keep its nodes in a NodeArena
+        self.arena = arena
+
+    def create(self, persistent=False, arena=False, **options):
+        # Falls back to the plain tree when the variant asked for doesn't exist
+        if arena and self.arena:
+            return self.tree_class(arena=NodeArena(), **options)
+        if persistent and self.persistent_class:
+            return self.persistent_class(**options)
+        return self.tree_class(**options)
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    ENGINES[engine.name] = engine
+    return engine
+
+
+register_engine(Engine("bst", "Binary Search Tree", BinarySearchTree, PersistentBST, arena=True))
+register_engine(Engine("avl", "AVL Tree", AVLTree, PersistentAVLTree, arena=True))
+register_engine(Engine("redblack", "Red-Black Tree", RedBlackTree))
+register_engine(Engine("treap", "Treap", Treap))
+register_engine(Engine("btree", "B-Tree", BTree))
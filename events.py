@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+
+# Fans published tree versions out to /events subscribers. Writers publish
+# with the session lock held and must never wait for a slow reader, so each
+# subscriber gets a bounded queue: once it falls max_pending versions behind,
+# its queue is dropped and it is flagged to receive a full snapshot the next
+# time it reads, which costs one render however far behind it was.
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.pending = deque()
+        self.resync = False
+        self.closed = False
+
+    def wait(self, timeout):
+        # Returns (resync, [(since, version, changes), ...]) once something
+        # was published or timeout seconds have passed
+        with self.broadcaster.condition:
+            if not self.pending and not self.resync and not self.closed:
+                self.broadcaster.condition.wait(timeout)
+            batch = list(self.pending)
+            self.pending.clear()
+            resync, self.resync = self.resync, False
+            return resync, batch
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+class EventBroadcaster:
+    def __init__(self, max_pending=256, max_subscribers=100):
+        self.max_pending = max_pending
+        self.max_subscribers = max_subscribers
+        self.condition = threading.Condition()
+        self.subscribers = set()
+
+    def subscribe(self):
+        with self.condition:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise TooManySubscribers("Too many subscribers")
+            subscription = Subscription(self)
+            self.subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self.subscribers.discard(subscription)
+
+    def publish(self, since, version, changes):
+        with self.condition:
+            if not self.subscribers:
+                return
+            for subscription in self.subscribers:
+                if subscription.resync:
+                    continue
+                if len(subscription.pending) >= self.max_pending:
+                    subscription.pending.clear()
+                    subscription.resync = True
+                else:
+                    subscription.pending.append((since, version, changes))
+            self.condition.notify_all()
+
+    def close(self):
+        # Ends every stream, e.g. when the tree is evicted
+        with self.condition:
+            for subscription in self.subscribers:
+                subscription.closed = True
+            self.subscribers.clear()
+            self.condition.notify_all()
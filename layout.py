@@ -0,0 +1,286 @@
+import json
+import threading
+from collections import deque
+
+# Tidy tree drawing in the style of Reingold and Tilford. Each subtree is laid
+# out on its own, then the two children of a node are pushed apart until the
+# right contour of the left subtree and the left contour of the right subtree
+# are at least one unit apart on every level they share, and the parent is
+# centred above them. Only the shared levels are compared, which keeps the
+# whole layout linear in the number of nodes.
+#
+# Contours are immutable linked cells (dx, next), one per level below the
+# subtree root, where dx is the horizontal step from the level above. A parent
+# reuses the deeper child's contour as its tail, so subtree layouts never
+# change once built. For path-copying trees that means the layout of every
+# subtree the last mutation didn't copy can be reused as is, and only the
+# copied spine is laid out again.
+#
+# Coordinates are in node units. Each node carries dx, its horizontal offset
+# from its parent, and the root sits at x = 0, so x - left (the leftmost x,
+# sent with every layout) puts the leftmost node at 0. y is the depth.
+
+SIBLING_GAP = 1.0
+SINGLE_CHILD_OFFSET = 0.5
+
+
+class SubtreeLayout:
+    __slots__ = ("node", "left", "right", "height", "child_dx",
+                 "left_contour", "right_contour")
+
+    def __init__(self, node, left, right):
+        self.node = node
+        self.left = left
+        self.right = right
+
+        if left and right:
+            offset = separation(left.right_contour, right.left_contour) / 2
+            self.child_dx = offset
+            self.height = 1 + max(left.height, right.height)
+            self.left_contour = join_contours(left.left_contour, left.height, -offset,
+                                              right.left_contour, right.height, offset)
+            self.right_contour = join_contours(right.right_contour, right.height, offset,
+                                               left.right_contour, left.height, -offset)
+        elif left or right:
+            child = left or right
+            dx = -SINGLE_CHILD_OFFSET if left else SINGLE_CHILD_OFFSET
+            self.child_dx = SINGLE_CHILD_OFFSET
+            self.height = 1 + child.height
+            self.left_contour = (dx, child.left_contour)
+            self.right_contour = (dx, child.right_contour)
+        else:
+            self.child_dx = 0.0
+            self.height = 1
+            self.left_contour = None
+            self.right_contour = None
+
+
+def separation(left_contour, right_contour):
+    # Smallest distance between the two subtree roots that keeps every shared
+    # level SIBLING_GAP apart
+    gap = SIBLING_GAP
+    left_x = right_x = 0.0
+    while left_contour and right_contour:
+        left_x += left_contour[0]
+        right_x += right_contour[0]
+        gap = max(gap, left_x - right_x + SIBLING_GAP)
+        left_contour = left_contour[1]
+        right_contour = right_contour[1]
+    return gap
+
+
+def join_contours(near, near_height, near_dx, far, far_height, far_dx):
+    # Contour of a parent on one side: the near child's contour, continued by
+    # the far child's below the near child's last level. near_dx and far_dx
+    # are the children's offsets from the parent.
+    if near_height >= far_height:
+        return (near_dx, near)
+
+    # The near part has to be copied because its last cell gains a successor
+    steps = [near_dx]
+    near_x = near_dx
+    while near:
+        steps.append(near[0])
+        near_x += near[0]
+        near = near[1]
+
+    far_x = far_dx
+    for _ in range(near_height):
+        far_x += far[0]
+        far = far[1]
+
+    contour = (far_x - near_x, far)
+    for dx in reversed(steps):
+        contour = (dx, contour)
+    return contour
+
+
+class TreeLayout:
+    # Holds the node positions of the latest version laid out, and the
+    # changes of the last history versions, so a client with a recent layout
+    # only downloads the nodes that moved. With reuse_nodes (path-copying
+    # trees, whose nodes never change) subtree layouts are remembered by node
+    # across versions, and a subtree whose layout object is the one already
+    # placed under its key is skipped without being walked. Safe to call
+    # from several threads.
+    def __init__(self, history=32):
+        self._lock = threading.Lock()
+        self._history = deque(maxlen=history)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.version = None
+            self._top = None
+            self._subtrees = {}
+            self._placed = {}
+            self._positions = {}
+            self._bounds = bounds(None)
+            self._history.clear()
+            self._rendered = None
+
+    def update(self, root, version, reuse_nodes=False):
+        # Lays out root as version. A version no newer than the one held is
+        # ignored: it comes from a reader that pinned its root before a
+        # later update got here.
+        with self._lock:
+            if self.version is not None and version <= self.version:
+                return
+            subtrees = self._subtrees if reuse_nodes else {}
+            top = self._build(root, subtrees)
+            if reuse_nodes and top:
+                self._prune(top, root)
+
+            changed, placed, removed = self._diff(top, reuse_nodes)
+            for key in removed:
+                del self._positions[key]
+                self._placed.pop(key, None)
+            self._positions.update(changed)
+            if reuse_nodes:
+                self._placed.update(placed)
+            if self.version is not None:
+                self._history.append((self.version, version, changed, removed))
+            self._top = top
+            self.version = version
+            self._bounds = bounds(top)
+            self._rendered = None
+
+    def render(self, since=None, **header):
+        # JSON text of the layout held, with the header fields in front. With
+        # since, a version the caller already has, only the nodes that changed
+        # after it are listed, plus the keys that were removed; when since is
+        # too old every node is listed and "since" is left out.
+        with self._lock:
+            changes = self._changes_since(since)
+            if changes is None:
+                if self._rendered is None:
+                    self._rendered = self._dumps(header, list(self._positions.values()))
+                return self._rendered
+            changed, removed = changes
+            return self._dumps(dict(header, since=since), list(changed.values()), removed=removed)
+
+    def _dumps(self, header, nodes, **fields):
+        state = dict(header, version=self.version, **self._bounds)
+        state.update(fields)
+        state["nodes"] = nodes
+        return json.dumps(state, separators=(",", ":"))
+
+    def _changes_since(self, since):
+        # Merges the changes of every version after since, or returns None
+        # when they are no longer kept
+        if since is None or self.version is None:
+            return None
+        if since == self.version:
+            return {}, []
+
+        changed = {}
+        removed = set()
+        found = False
+        for start, _, step_changed, step_removed in self._history:
+            found = found or start == since
+            if not found:
+                continue
+            for key in step_removed:
+                changed.pop(key, None)
+                removed.add(key)
+            for key, entry in step_changed.items():
+                changed[key] = entry
+                removed.discard(key)
+        return (changed, list(removed)) if found else None
+
+    def _diff(self, top, reuse_nodes):
+        # Node entries hold the offset from the parent rather than an
+        # absolute x, so a node only changes when its own parent, side or
+        # offset does. Below a subtree that is already placed under its key
+        # nothing can have changed. Returns the changed entries by key, the
+        # layouts of the nodes walked by key, and the removed keys.
+        positions = self._positions
+        previous = self._placed if reuse_nodes else {}
+        changed = {}
+        placed = {}
+        kept = set()
+        stack = [(top, 0.0, None, None)] if top else []
+        while stack:
+            subtree, dx, parent, side = stack.pop()
+            key = subtree.node.key
+            entry = {"key": key, "dx": dx, "parent": parent, "side": side}
+            if positions.get(key) != entry:
+                changed[key] = entry
+            if previous.get(key) is subtree:
+                kept.add(key)
+                continue
+            placed[key] = subtree
+            if subtree.right:
+                stack.append((subtree.right, subtree.child_dx, key, "right"))
+            if subtree.left:
+                stack.append((subtree.left, -subtree.child_dx, key, "left"))
+
+        if not reuse_nodes:
+            return changed, placed, [key for key in positions if key not in placed]
+
+        # The previous layout, walked the same way: its keys outside the kept
+        # subtrees that weren't walked above have left the tree
+        removed = []
+        stack = [self._top] if self._top else []
+        while stack:
+            subtree = stack.pop()
+            key = subtree.node.key
+            if key in kept:
+                continue
+            if key not in placed:
+                removed.append(key)
+            stack.extend(child for child in (subtree.left, subtree.right) if child)
+        return changed, placed, removed
+
+    def _build(self, root, subtrees):
+        # Post-order without recursion so degenerate trees don't hit the
+        # recursion limit
+        if not root:
+            return None
+        built = subtrees.get(root)
+        if built:
+            return built
+
+        stack = [(root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                subtrees[node] = SubtreeLayout(node, subtrees.get(node.left), subtrees.get(node.right))
+                continue
+            stack.append((node, True))
+            for child in (node.right, node.left):
+                if child and child not in subtrees:
+                    stack.append((child, False))
+        return subtrees[root]
+
+    def _prune(self, top, root):
+        # Layouts of nodes that left the tree are kept until they outnumber
+        # the live ones, then the cache is rebuilt from the current tree
+        if len(self._subtrees) <= 2 * root.size + 64:
+            return
+        live = {}
+        stack = [top]
+        while stack:
+            subtree = stack.pop()
+            live[subtree.node] = subtree
+            stack.extend(child for child in (subtree.left, subtree.right) if child)
+        self._subtrees = live
+
+
+def bounds(top):
+    # Leftmost x relative to the root, width and depth, read off the root's
+    # contours in time proportional to the height
+    if top is None:
+        return {"left": 0.0, "width": 0.0, "depth": 0}
+    left = right = 0.0
+    x, contour = 0.0, top.left_contour
+    while contour:
+        x += contour[0]
+        left = min(left, x)
+        contour = contour[1]
+    x, contour = 0.0, top.right_contour
+    while contour:
+        x += contour[0]
+        right = max(right, x)
+        contour = contour[1]
+    return {"left": left, "width": right - left, "depth": top.height}
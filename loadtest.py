@@ -0,0 +1,194 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from engines import ENGINES
+
+# Replays a mixed insert/delete/search/traverse workload from --clients
+# simulated users and reports throughput and p50/p99 latency per endpoint.
+# Each client sends its next request as soon as the last one is answered,
+# so the numbers show how the server behaves with that many concurrent users.
+#
+# Without --url the backend is started in this process through serve.py's
+# pooled server, with its files in a temporary directory; with --url an
+# already running server is tested. Requests go to their own tree
+# (--tree-id) so the load never touches the default tree.
+
+DEFAULT_MIX = "insert=30,delete=20,search=45,traverse=5"
+ENDPOINTS = ("insert", "delete", "search", "traverse")
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+class Client(threading.Thread):
+    def __init__(self, address, args, seed, deadline):
+        super().__init__(daemon=True)
+        self.address = address
+        self.args = args
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.operations = list(args.mix)
+        self.weights = [args.mix[name] for name in self.operations]
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+
+    def body(self, operation):
+        if operation == "traverse":
+            return {"type": "inorder", "limit": self.args.traverse_limit,
+                    "offset": self.rng.randrange(self.args.keys), "tree_id": self.args.tree_id}
+        return {"key": self.rng.randrange(self.args.keys), "tree_id": self.args.tree_id}
+
+    def run(self):
+        host, port = self.address
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        headers = {"Content-Type": "application/json"}
+        count = 0
+        while time.monotonic() < self.deadline and count != self.args.requests:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            payload = json.dumps(self.body(operation))
+            started = time.perf_counter()
+            try:
+                connection.request("POST", "/" + operation, payload, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                ok = False
+            elapsed = time.perf_counter() - started
+
+            # Duplicate inserts and missing deletes are answered normally;
+            # only transport failures and error statuses count as errors
+            if ok:
+                self.latencies[operation].append(elapsed)
+            else:
+                self.errors[operation] += 1
+            count += 1
+        connection.close()
+
+
+def post(address, path, body):
+    connection = http.client.HTTPConnection(*address, timeout=60)
+    try:
+        connection.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def run_load(address, args):
+    post(address, "/initialize", {"type": args.tree, "tree_id": args.tree_id})
+    if args.preload:
+        keys = random.Random(args.seed).sample(range(args.keys), min(args.preload, args.keys))
+        post(address, "/bulk_insert", {"keys": keys, "tree_id": args.tree_id})
+
+    deadline = time.monotonic() + args.duration
+    clients = [Client(address, args, args.seed + i + 1, deadline) for i in range(args.clients)]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+
+    results = []
+    for name in ENDPOINTS:
+        latencies = sorted(value for client in clients for value in client.latencies[name])
+        errors = sum(client.errors[name] for client in clients)
+        if not latencies and not errors:
+            continue
+        results.append({
+            "endpoint": "/" + name,
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)
+        })
+    total = sum(result["requests"] for result in results)
+    return {"clients": args.clients, "seconds": round(elapsed, 2),
+            "throughput": round(total / elapsed, 1), "endpoints": results}
+
+
+def start_local_server(threads):
+    # Imported here so testing a remote server doesn't load the backend
+    import serve
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # No access log
+    server = serve.make_server("127.0.0.1", 0, threads=threads)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, serve.registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the tree backend")
+    parser.add_argument("--url", help="server to test, e.g. http://127.0.0.1:5000 "
+                                      "(default: start one in this process)")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=-1,
+                        help="stop each client after this many requests")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--keys", type=int, default=100_000, help="keys are drawn from range(KEYS)")
+    parser.add_argument("--preload", type=int, default=10_000, help="keys loaded before the run")
+    parser.add_argument("--traverse-limit", type=int, default=100)
+    parser.add_argument("--tree", choices=sorted(ENGINES), default="avl")
+    parser.add_argument("--tree-id", default="loadtest")
+    parser.add_argument("--threads", type=int, default=16, help="server threads without --url")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if args.url:
+        url = urlsplit(args.url)
+        result = run_load((url.hostname, url.port or 80), args)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            server, registry = start_local_server(args.threads)
+            try:
+                result = run_load(server.server_address[:2], args)
+            finally:
+                server.shutdown()
+                server.server_close()
+                registry.close()
+
+    if args.json:
+        print(json.dumps(result))
+        return
+
+    print(f"{result['clients']} clients, {result['seconds']}s, {result['throughput']} req/s")
+    print(f"{'endpoint':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for row in result["endpoints"]:
+        print(f"{row['endpoint']:<10} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>9} "
+              f"{row['p50_ms']:>9} {row['p99_ms']:>9}")
+    if any(row["errors"] for row in result["endpoints"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
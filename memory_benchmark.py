@@ -0,0 +1,79 @@
+import argparse
+import gc
+import json
+import random
+import sys
+import tracemalloc
+
+from arena import NodeArena
+from trees import BinarySearchTree, AVLTree
+
+# Compares the memory used by object nodes and arena-backed nodes. Each tree
+# is built from the same shuffled keys with inserts followed by a round of
+# deletes, so the arena's free list is exercised too. Sizes are measured with
+# tracemalloc; "bytes" covers the whole tree and "node_bytes" leaves out the
+# key index, which is the same for both layouts.
+
+TREES = {
+    "bst": BinarySearchTree,
+    "avl": AVLTree
+}
+
+LAYOUTS = ("objects", "arena")
+
+
+def build_tree(tree_class, layout, keys):
+    tree = tree_class(arena=NodeArena() if layout == "arena" else None)
+    for key in keys:
+        tree.insert(key)
+    for key in keys[::10]:
+        tree.delete(key)
+    return tree
+
+
+def measure(tree_class, layout, keys):
+    gc.collect()
+    tracemalloc.start()
+    tree = build_tree(tree_class, layout, keys)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = len(tree.inserted_keys)
+    node_bytes = current - sys.getsizeof(tree.inserted_keys._keys)
+    return {
+        "tree": tree_class.__name__,
+        "layout": layout,
+        "keys": size,
+        "bytes": current,
+        "node_bytes": node_bytes,
+        "node_bytes_per_key": round(node_bytes / size, 1) if size else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare node memory layouts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--trees", nargs="+", choices=sorted(TREES), default=sorted(TREES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        keys = list(range(size))
+        rng.shuffle(keys)
+
+        for name in args.trees:
+            for layout in LAYOUTS:
+                result = measure(TREES[name], layout, keys)
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print(f"{result['tree']:<17} {layout:<8} {result['keys']:>9} keys "
+                          f"{result['bytes'] / 1e6:>8.1f} MB total "
+                          f"{result['node_bytes_per_key']:>7.1f} B/key in nodes")
+
+
+if __name__ == "__main__":
+    main()
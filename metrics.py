@@ -0,0 +1,104 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Request latency histograms and tree counters in the Prometheus text
+# exposition format. Recording a request costs a bisect and a few additions
+# under a lock; the text is only built when /metrics is scraped.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class PhaseTimer:
+    # Time spent in each phase of one request. Phases may be entered more
+    # than once; their times add up.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class RequestMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, timer):
+        # Records the request's total time and each phase it went through
+        observations = [("total", timer.elapsed())]
+        observations.extend(timer.phases.items())
+        with self._lock:
+            for phase, seconds in observations:
+                histogram = self._histograms.get((endpoint, phase))
+                if histogram is None:
+                    histogram = self._histograms[endpoint, phase] = Histogram(self.buckets)
+                histogram.observe(seconds)
+
+    def render(self):
+        lines = ["# HELP tree_request_duration_seconds Request latency by endpoint and phase",
+                 "# TYPE tree_request_duration_seconds histogram"]
+        with self._lock:
+            for (endpoint, phase), histogram in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'tree_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'tree_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"tree_request_duration_seconds_sum{{{labels}}} {histogram.total}")
+                lines.append(f"tree_request_duration_seconds_count{{{labels}}} {histogram.count}")
+        return lines
+
+
+# (name, type, help) for the per-tree series; values come from tree_values()
+TREE_METRICS = (
+    ("tree_size", "gauge", "Keys in the tree"),
+    ("tree_height", "gauge", "Height of the tree"),
+    ("tree_rotations_total", "counter", "Rotations performed"),
+    ("tree_comparisons_total", "counter", "Key comparisons made by lookups and updates"),
+    ("tree_nodes_visited_total", "counter", "Nodes visited by lookups and updates"),
+)
+
+
+def tree_values(tree):
+    stats = tree.stats
+    return (len(tree.inserted_keys), tree.tree_height(),
+            stats.rotations, stats.comparisons, stats.nodes_visited)
+
+
+def render_tree_metrics(trees):
+    # trees is a list of (tree_id, tree_type, tree) for the loaded trees
+    rows = [(f'tree_id="{tree_id}",type="{tree_type}"', tree_values(tree))
+            for tree_id, tree_type, tree in trees]
+    lines = []
+    for i, (name, kind, description) in enumerate(TREE_METRICS):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, values in rows:
+            lines.append(f"{name}{{{labels}}} {values[i]}")
+    return lines
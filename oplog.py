@@ -0,0 +1,222 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import snapshot
+
+# Append-only operation log with snapshot compaction.
+#
+# Every mutation is appended to the log as one JSON line tagged with a
+# sequence number. Lines are flushed on every append and fsynced in groups of
+# sync_every records. The registry's maintenance thread (see sessions.py)
+# folds the log into a snapshot (tree.json) once the log grows past
+# compact_bytes or compact_interval seconds have passed since the last
+# compaction. The snapshot records the last sequence number it covers, so a
+# reader rebuilds the current state from the snapshot plus every log record
+# after that number. Snapshots may be JSON or binary (see snapshot.py); the
+# format is detected when reading.
+
+
+def read_snapshot_header(path):
+    # The snapshot is written with "tree" as its last field, so type, seq and
+    # insertedKeys can be read without building the nested tree dicts.
+    # Quotes inside JSON strings are always escaped, so the marker can only
+    # match the top-level field.
+    if snapshot.is_binary_snapshot(path):
+        try:
+            return snapshot.read_header(path)
+        except ValueError:
+            return None
+
+    try:
+        with open(path) as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+
+    cut = text.find(', "tree": ')
+    if cut != -1:
+        text = text[:cut] + "}"
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def truncate_torn_tail(path):
+    # Cuts the file back to the end of its last complete record, so a record
+    # half-written at a crash isn't joined with the next append. A record is
+    # complete once its newline is written.
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            end += len(line)
+        if end < f.seek(0, os.SEEK_END):
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class OperationLog:
+    def __init__(self, snapshot_path="tree.json", log_path="tree.log", lock=None,
+                 sync_every=16, compact_bytes=4 * 1024 * 1024, compact_interval=60.0):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.old_log_path = log_path + ".old"
+        self.lock = lock or threading.RLock()
+        self.sync_every = sync_every
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+
+        self.seq = 0
+        self._log = None
+        self._unsynced = 0
+        self._records_since_compaction = 0
+        self._last_compaction = time.monotonic()
+        self._compact_lock = threading.Lock()
+
+    def recover(self):
+        # Reads the persisted state and opens the log for appending. Returns
+        # the state as {"type", "seq", "fromSnapshot", "tail"} (see
+        # read_state).
+        for path in (self.old_log_path, self.log_path):
+            truncate_torn_tail(path)
+        state = self.read_state()
+        with self.lock:
+            self.seq = state["seq"]
+            self._log = open(self.log_path, "a")
+        return state
+
+    def read_state(self):
+        # Returns the tree type, the last sequence number and the log records
+        # after the snapshot as tail. The tail is replayed onto the
+        # snapshot's tree when fromSnapshot is set and onto an empty tree
+        # otherwise (the log holds an initialize; tail starts after the last
+        # one).
+        header = read_snapshot_header(self.snapshot_path) or {}
+        tree_type = header.get("type", "bst")
+        seq = header.get("seq", 0)
+        tail = []
+        from_snapshot = True
+
+        for record in self._tail_records(seq):
+            if record["op"] == "initialize":
+                tree_type = record["type"]
+                tail = []
+                from_snapshot = False
+            else:
+                tail.append(record)
+            seq = record["seq"]
+
+        return {"type": tree_type, "seq": seq, "fromSnapshot": from_snapshot, "tail": tail}
+
+    def _tail_records(self, after_seq):
+        for path in (self.old_log_path, self.log_path):
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn write at the end of the file
+                    if record["seq"] > after_seq:
+                        yield record
+
+    def append(self, op, **fields):
+        with self.lock:
+            self.seq += 1
+            record = {"seq": self.seq, "op": op}
+            record.update(fields)
+            self._log.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._log.flush()
+
+            self._unsynced += 1
+            self._records_since_compaction += 1
+            if self._unsynced >= self.sync_every:
+                self._sync()
+            return self.seq
+
+    def sync(self):
+        with self.lock:
+            if self._log and self._unsynced:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._log.fileno())
+        self._unsynced = 0
+
+    def is_dirty(self):
+        # True when the log holds records the snapshot doesn't cover yet
+        with self.lock:
+            return self._records_since_compaction > 0
+
+    def needs_compaction(self):
+        with self.lock:
+            if not self._log or not self._records_since_compaction:
+                return False
+            if self._log.tell() >= self.compact_bytes:
+                return True
+            return time.monotonic() - self._last_compaction >= self.compact_interval
+
+    def compact(self, render):
+        # render(seq) must return the snapshot (text or bytes) for the
+        # current state.
+        # It runs under the lock together with the log rotation, so the
+        # snapshot covers exactly the records up to seq. The slow part,
+        # writing the snapshot file, happens after the lock is released.
+        with self._compact_lock:
+            with self.lock:
+                if not self._log:
+                    return None  # Closed, or never recovered
+                seq = self.seq
+                text = render(seq)
+                self._rotate()
+
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "wb" if isinstance(text, bytes) else "w") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            if os.path.exists(self.old_log_path):
+                os.remove(self.old_log_path)
+            return seq
+
+    def _rotate(self):
+        self._sync()
+        self._log.close()
+        # A leftover segment means the previous compaction never wrote its
+        # snapshot; keep its records by appending the current log to it.
+        if os.path.exists(self.old_log_path):
+            with open(self.log_path) as src, open(self.old_log_path, "a") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self.old_log_path)
+
+        self._log = open(self.log_path, "a")
+        self._records_since_compaction = 0
+        self._last_compaction = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self._log:
+                self._sync()
+                self._log.close()
+                self._log = None
@@ -0,0 +1,100 @@
+from trees import BinarySearchTree, AVLTree, subtree_height, subtree_size
+
+# Path-copying variants of the tree classes. Nodes reachable from a published
+# root are never modified: a mutation copies the nodes on its root-to-leaf
+# path (plus the few nodes a rotation touches), links the copies bottom-up
+# and publishes the new root with a single assignment. A reader that reads
+# tree.root once holds a consistent snapshot for as long as it keeps it,
+# without taking a lock. Writers still have to be serialized with each other.
+#
+# Nodes are always plain objects here: an arena reuses and rewrites slots in
+# place, which would break old snapshots.
+
+
+class PersistentBST(BinarySearchTree):
+    persistent = True
+
+    def __init__(self):
+        super().__init__()
+
+    def _insert_key(self, key):
+        path = []
+        current = self.root
+        while current:
+            went_left = key < current.key
+            path.append((current, went_left))
+            current = current.left if went_left else current.right
+        self.stats.visit(len(path), len(path))
+        self._trace_insert(key, (node.key for node, _ in path))
+
+        self.root = self._copy_path(path, self.node_class(key))
+
+    def _delete_key(self, key):
+        path = []
+        current = self.root
+        while current and current.key != key:
+            went_left = key < current.key
+            path.append((current, went_left))
+            current = current.left if went_left else current.right
+
+        self.stats.visit_search(len(path), bool(current))
+        self._trace_compare((node.key for node, _ in path), current)
+        if not current:
+            return
+
+        # Node with two children: its copy takes the in-order successor's
+        # key and the successor is unlinked instead
+        replaced = None
+        if current.left and current.right:
+            replaced = len(path)
+            path.append((current, False))
+            successor = current.right
+            while successor.left:
+                path.append((successor, True))
+                successor = successor.left
+            self.stats.visit(len(path) - replaced, 0)
+            self._trace_successor(current.key, [node.key for node, _ in path[replaced + 1:]] + [successor.key])
+            current = successor
+
+        self.root = self._copy_path(path, current.left or current.right,
+                                    replaced, current.key)
+
+    def _copy_path(self, path, child, replaced=None, new_key=None):
+        # Copies path bottom-up, hanging child (the new or shortened subtree)
+        # under the lowest copy. Returns the new root.
+        for i in range(len(path) - 1, -1, -1):
+            node, went_left = path[i]
+            node = node.copy()
+            if went_left:
+                node.left = child
+            else:
+                node.right = child
+            if i == replaced:
+                node.key = new_key
+            node.size = 1 + subtree_size(node.left) + subtree_size(node.right)
+            node.height = 1 + max(subtree_height(node.left), subtree_height(node.right))
+            child = self._repair(node)
+        return child
+
+    def _repair(self, node):
+        return node
+
+
+class PersistentAVLTree(PersistentBST, AVLTree):
+    def _repair(self, node):
+        return self._rebalance(node)
+
+    # Rotations change the rotated node and one of its children; both are
+    # copied first because either may still be shared with older snapshots
+    def right_rotate(self, y):
+        y = y.copy()
+        y.left = y.left.copy()
+        return super().right_rotate(y)
+
+    def left_rotate(self, x):
+        x = x.copy()
+        x.right = x.right.copy()
+        return super().left_rotate(x)
+
+    def _link(self, node, left, right):
+        return super()._link(node.copy(), left, right)
@@ -0,0 +1,143 @@
+from trees import BinarySearchTree, TreeNode
+
+# Red-black tree. Every node is red or black, a red node has no red child and
+# every path from a node down to a missing child passes the same number of
+# black nodes, so the longest path is at most twice the shortest. That is a
+# looser balance than AVL's (up to 2 log n levels instead of about 1.44 log
+# n) in exchange for fewer rotations: an insert rotates at most twice and a
+# delete at most three times, however far its recoloring travels.
+#
+# Inserts and deletes reuse the plain BST descent and splice and then fix the
+# colors on the way back up the path they took. Colors aren't part of the
+# key/left/right shape, so these trees are saved as JSON snapshots and
+# rebuilt from their keys.
+
+
+class RedBlackNode(TreeNode):
+    __slots__ = ("red",)
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.red = True  # New nodes start red so black heights are unchanged
+
+
+def is_red(node):
+    return node is not None and node.red
+
+
+class RedBlackTree(BinarySearchTree):
+    node_class = RedBlackNode
+    binary_snapshot = False
+
+    def _after_insert(self, path, node):
+        key = node.key
+        rotated = False
+        # A red parent is never the root, so it always has a parent itself
+        while path and path[-1].red:
+            parent = path.pop()
+            grandparent = path.pop()
+            uncle = grandparent.right if parent is grandparent.left else grandparent.left
+            if is_red(uncle):
+                # Push the red up: recolor and continue from the grandparent
+                parent.red = uncle.red = False
+                grandparent.red = True
+                node = grandparent
+                continue
+
+            # Rotate the red pair over the grandparent; an inner child is
+            # rotated to the outside first
+            if parent is grandparent.left:
+                if node is parent.right:
+                    grandparent.left = self.left_rotate(parent)
+                top = self.right_rotate(grandparent)
+            else:
+                if node is parent.left:
+                    grandparent.right = self.right_rotate(parent)
+                top = self.left_rotate(grandparent)
+            self._replace_child(path[-1] if path else None, grandparent, top)
+            top.red = False
+            grandparent.red = True
+            rotated = True
+            break
+
+        self.root.red = False
+        if rotated:
+            self._refresh_heights(key)
+
+    def _after_delete(self, ancestors, removed, child):
+        # Removing a red node, or a black one with a red child to take its
+        # color, keeps every black height. Otherwise the path through child
+        # is one black short, and x (child, then an ancestor) carries the
+        # missing black up until a red node or a rotation absorbs it.
+        if removed.red:
+            return
+
+        path = ancestors
+        x = child
+        rotated = False
+        while path and not is_red(x):
+            parent = path[-1]
+            left = x is parent.left
+            sibling = parent.right if left else parent.left
+
+            if sibling.red:
+                # Make the sibling black: rotate it above parent
+                sibling.red = False
+                parent.red = True
+                top = self.left_rotate(parent) if left else self.right_rotate(parent)
+                self._replace_child(path[-2] if len(path) > 1 else None, parent, top)
+                path.insert(len(path) - 1, top)
+                sibling = parent.right if left else parent.left
+                rotated = True
+
+            near, far = (sibling.left, sibling.right) if left else (sibling.right, sibling.left)
+            if not is_red(near) and not is_red(far):
+                # Take one black off the sibling's side as well and move up
+                sibling.red = True
+                x = path.pop()
+                continue
+
+            if not is_red(far):
+                # Rotate the red near child to the outside
+                near.red = False
+                sibling.red = True
+                if left:
+                    sibling = parent.right = self.right_rotate(sibling)
+                else:
+                    sibling = parent.left = self.left_rotate(sibling)
+                far = sibling.right if left else sibling.left
+
+            # The sibling takes parent's place and color; parent and the far
+            # child turn black, which restores the missing black
+            sibling.red = parent.red
+            parent.red = False
+            far.red = False
+            top = self.left_rotate(parent) if left else self.right_rotate(parent)
+            self._replace_child(path[-2] if len(path) > 1 else None, parent, top)
+            rotated = True
+            x = None
+            break
+
+        if x is not None:
+            x.red = False
+        if self.root:
+            self.root.red = False
+        if rotated:
+            self._refresh_heights(removed.key)
+
+    def bulk_load(self, keys):
+        # The rebuilt tree is balanced with its missing children on its last
+        # two levels, so coloring the nodes of the deepest level red (and
+        # the rest black) gives every path the same black height
+        added = super().bulk_load(keys)
+        if added:
+            red_depth = self.root.height - 1
+            stack = [(self.root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                node.red = depth == red_depth and depth > 0
+                if node.left:
+                    stack.append((node.left, depth + 1))
+                if node.right:
+                    stack.append((node.right, depth + 1))
+        return added
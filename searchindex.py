@@ -0,0 +1,71 @@
+from bisect import bisect_left
+
+from snapshot import key_typecode
+
+try:
+    import numpy
+except ImportError:  # Optional: lookups fall back to bisect
+    numpy = None
+
+# Answers many membership lookups at once from a sorted copy of one tree
+# version's keys. Each key's in-order position is its rank, and its depth in
+# the tree is stored next to it, so a lookup is one binary search however
+# deep the tree is. With NumPy, a whole batch is a single searchsorted call;
+# without it, or for keys NumPy can't hold exactly (strings, integers beyond
+# int64), each key is looked up with bisect.
+
+
+class SearchIndex:
+    def __init__(self, key_depths, version):
+        # key_depths is the tree's (key, depth) pairs in key order
+        self.version = version
+        keys = []
+        depths = []
+        for key, depth in key_depths:
+            keys.append(key)
+            depths.append(depth)
+        self.keys = keys
+        self.depths = depths
+
+        self.key_array = None
+        if numpy is not None and keys:
+            try:
+                typecode = key_typecode(keys)
+            except ValueError:
+                pass
+            else:
+                self.key_array = numpy.array(keys, dtype=numpy.int64 if typecode == "q" else numpy.float64)
+                self.depth_array = numpy.array(depths, dtype=numpy.int32)
+
+    def search_many(self, queries):
+        # Returns (found, ranks, depths) as lists. rank is the number of keys
+        # smaller than the query, like trees.rank(); depth counts from 0 at
+        # the root, like search()'s level, and is None for missing keys.
+        if not self.keys:
+            return [False] * len(queries), [0] * len(queries), [None] * len(queries)
+
+        if self.key_array is not None:
+            values = numpy.asarray(queries)
+            if values.ndim == 1 and values.dtype.kind in "iuf":
+                return self._search_array(values)
+        return self._search_list(queries)
+
+    def _search_array(self, values):
+        ranks = numpy.searchsorted(self.key_array, values)
+        positions = numpy.minimum(ranks, len(self.keys) - 1)
+        found = (ranks < len(self.keys)) & (self.key_array[positions] == values)
+        depths = numpy.where(found, self.depth_array[positions], -1)
+        return (found.tolist(), ranks.tolist(),
+                [depth if depth >= 0 else None for depth in depths.tolist()])
+
+    def _search_list(self, queries):
+        # Raises TypeError for keys that can't be compared with the tree's
+        keys = self.keys
+        found, ranks, depths = [], [], []
+        for key in queries:
+            position = bisect_left(keys, key)
+            hit = position < len(keys) and keys[position] == key
+            found.append(hit)
+            ranks.append(position)
+            depths.append(self.depths[position] if hit else None)
+        return found, ranks, depths
@@ -0,0 +1,93 @@
+import argparse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from backend import app, registry
+
+# Production entry point: no debugger, no reloader, a bounded pool of request
+# threads. Trees live in this process's memory and each one appends to its own
+# log file, so the server is always a single process that scales with
+# threads. A second process would load the same trees and interleave writes
+# to their logs. Under gunicorn the same holds:
+#
+#   gunicorn --workers 1 --worker-class gthread --threads 16 serve:app
+#
+# Every open /events stream holds a thread for as long as it is connected,
+# so --threads has to cover the expected watchers as well as the requests.
+#
+# Uses waitress when it is installed (pip install waitress), otherwise
+# Werkzeug's server with a thread pool.
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    # Werkzeug's threaded server starts a new thread for every connection;
+    # this one hands connections to a fixed pool, so load beyond the pool
+    # waits in the listen backlog instead of piling up threads
+    multithread = True
+
+    def __init__(self, host, port, app, threads, backlog):
+        self.request_queue_size = backlog
+        super().__init__(host, port, app)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def make_server(host, port, threads=16, backlog=128):
+    return PooledWSGIServer(host, port, app, threads, backlog)
+
+
+def serve_waitress(host, port, threads, backlog):
+    import waitress
+    waitress.serve(app, host=host, port=port, threads=threads, backlog=backlog,
+                   connection_limit=max(100, threads * 4))
+
+
+def serve_werkzeug(host, port, threads, backlog):
+    server = make_server(host, port, threads, backlog)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the tree backend")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=16, help="request threads")
+    parser.add_argument("--backlog", type=int, default=128, help="listen backlog")
+    parser.add_argument("--server", choices=("auto", "waitress", "werkzeug"), default="auto")
+    args = parser.parse_args()
+
+    server = args.server
+    if server == "auto":
+        server = "waitress" if importlib.util.find_spec("waitress") else "werkzeug"
+
+    registry.start()
+    print(f"Serving on http://{args.host}:{args.port} with {server}, {args.threads} threads")
+    if server == "waitress":
+        serve_waitress(args.host, args.port, args.threads, args.backlog)
+    else:
+        serve_werkzeug(args.host, args.port, args.threads, args.backlog)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import snapshot
+from events import EventBroadcaster
+from layout import TreeLayout
+from oplog import OperationLog
+from searchindex import SearchIndex
+from trees import KeyIndex
+
+# Named trees held in memory by a TreeRegistry. Each TreeSession owns one tree
+# together with its lock, version history and operation log. The registry
+# keeps sessions in least-recently-used order; when the estimated memory of
+# the loaded trees goes over the budget, or a tree sits idle for too long,
+# the least recently used idle session is compacted to disk and dropped. It
+# is loaded back from its snapshot and log on the next access. Only writes
+# create trees; reading a tree that has never been written raises
+# TreeNotFound.
+
+TREE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidTreeId(ValueError):
+    pass
+
+
+class TreeNotFound(LookupError):
+    pass
+
+
+class TreeSession:
+    def __init__(self, tree_id, oplog, create_tree, tree_types, delta_history,
+                 snapshot_format="json", event_settings=None):
+        self.tree_id = tree_id
+        self.oplog = oplog
+        # Writers hold this lock while they mutate the tree and append to the log
+        self.lock = oplog.lock
+        self.create_tree = create_tree
+        self.tree_types = tree_types
+        self.snapshot_format = snapshot_format
+
+        self.tree = None
+        self.tree_type = "bst"
+
+        # Every mutation bumps version. The last delta_history versions keep
+        # the changes they made so clients can catch up through /tree/delta;
+        # epoch changes whenever the tree is loaded so clients know their
+        # version numbers are stale.
+        self.version = 0
+        self.epoch = uuid.uuid4().hex
+        self.delta_history = deque(maxlen=delta_history)
+        self.layout = TreeLayout()
+        self._search_index = None
+        # Pushes each version's changes to /events subscribers
+        self.events = EventBroadcaster(**(event_settings or {}))
+
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def ensure_open(self):
+        with self.lock:
+            if self.tree is None:
+                self._restore(self.oplog.recover())
+
+    def _restore(self, state):
+        # Trees whose nodes are only key/left/right (see
+        # BinarySearchTree.binary_snapshot) get their saved shape back with
+        # the log tail replayed on top, so a plain BST comes back with the
+        # shape its inserts gave it. Other trees are rebuilt balanced by
+        # bulk_load from the snapshot's keys, read out in key order so
+        # nothing has to be sorted. A tree initialized since the snapshot is
+        # replayed from empty.
+        started = time.perf_counter()
+        self.tree_type = state["type"] if state["type"] in self.tree_types else "bst"
+        self.tree = self.create_tree(self.tree_type)
+        path = self.oplog.snapshot_path
+        if state["fromSnapshot"] and os.path.exists(path):
+            if self.tree.binary_snapshot:
+                snapshot.load_tree(path, self.tree)
+            else:
+                inserted, ordered = snapshot.read_keys(path)
+                self.tree.bulk_load(ordered)
+                self.tree.inserted_keys = KeyIndex(inserted)
+        self._replay(state["tail"])
+        self.tree.journal = []
+
+        elapsed = time.perf_counter() - started
+        logger.info("Restored %d keys into %s tree '%s' in %.2fs", len(self.tree.inserted_keys),
+                    self.tree_type, self.tree_id, elapsed)
+
+    def _replay(self, records):
+        # Applies logged records the way the backend applied them
+        tree = self.tree
+        for record in records:
+            op = record["op"]
+            if op == "insert":
+                tree.insert(record["key"])
+            elif op == "delete":
+                tree.delete(record["key"])
+            elif op == "bulk_insert":
+                tree.bulk_load(record["keys"])
+            elif op == "merge":
+                tree.union(record["keys"])
+            elif op == "delete_range":
+                tree.delete_range(record["lo"], record["hi"])
+            elif op == "batch":
+                for change in record["ops"]:
+                    if change["op"] == "insert":
+                        tree.insert(change["key"])
+                    else:
+                        tree.delete(change["key"])
+
+    def reset(self, new_type):
+        # Called with the lock held. Counters carry over so /metrics totals
+        # stay monotonic.
+        stats = self.tree.stats
+        self.tree = self.create_tree(new_type)
+        self.tree.stats = stats
+        self.tree_type = new_type
+        self.layout.clear()
+        self.oplog.append("initialize", type=new_type)
+        self.publish_changes([{"op": "reset", "type": new_type}])
+
+    def commit(self, op, **fields):
+        # Called with the lock held after a successful mutation: logs it and
+        # publishes what the tree journaled
+        self.oplog.append(op, **fields)
+        changes = self.tree.journal
+        self.tree.journal = []
+        self.publish_changes(changes)
+
+    def publish_changes(self, changes):
+        self.version += 1
+        self.delta_history.append((self.version, changes))
+        self.events.publish(self.version - 1, self.version, changes)
+
+    def subscribe(self, epoch=None, since=None):
+        # Returns the subscription, the changes a subscriber that was at
+        # version since of epoch has missed (None when it needs a snapshot)
+        # and the version they bring it to. Taken under the lock so nothing
+        # published in between is lost.
+        with self.lock:
+            subscription = self.events.subscribe()
+            changes = self.changes_since(since) if epoch == self.epoch else None
+            return subscription, changes, self.version
+
+    def changes_since(self, since):
+        # Returns None when the caller has to fall back to a full fetch
+        with self.lock:
+            oldest = self.delta_history[0][0] if self.delta_history else self.version + 1
+            if since is None or since > self.version or since < oldest - 1:
+                return None
+
+            changes = []
+            for version, version_changes in self.delta_history:
+                if version > since:
+                    changes.extend(version_changes)
+
+        # bulk_load rebuilds the whole tree, so there is nothing smaller to send
+        if any(change["op"] == "rebuild" for change in changes):
+            return None
+        return changes
+
+    def render_state(self, **header):
+        # The tree is written with to_json() rather than json.dump(to_dict())
+        # because the json encoder recurses once per level. "tree" must stay
+        # the last field so read_snapshot_header() can skip it.
+        parts = ['{"type": ' + json.dumps(self.tree_type)]
+        for name, value in header.items():
+            parts.append(', ' + json.dumps(name) + ': ' + json.dumps(value))
+        parts.append(', "insertedKeys": ' + json.dumps(self.tree.inserted_keys.to_list()))
+        parts.append(', "tree": ' + self.tree.to_json() + '}')
+        return "".join(parts)
+
+    def search_index(self):
+        # Sorted keys and depths for /search_many, rebuilt on the first call
+        # after each version
+        with self.lock:
+            index = self._search_index
+            if index is None or index.version != self.version:
+                index = self._search_index = SearchIndex(self.tree.key_depths(), self.version)
+            return index
+
+    def render_layout(self, since=None):
+        # The layout JSON (see TreeLayout.render), or None for trees that
+        # can't be drawn. A persistent tree is laid out from the root pinned
+        # under the lock once it is released; other trees while it is held.
+        # Writing the JSON never needs the lock.
+        with self.lock:
+            tree = self.tree
+            if not tree.binary:
+                return None
+            root, version = tree.root, self.version
+            if not tree.persistent:
+                self.layout.update(root, version)
+        if tree.persistent:
+            self.layout.update(root, version, reuse_nodes=True)
+        return self.layout.render(since, epoch=self.epoch)
+
+    def render_snapshot(self, seq):
+        if self.snapshot_format == "binary":
+            try:
+                return snapshot.render_snapshot(self.tree, self.tree_type, seq)
+            except ValueError:
+                pass  # Keys or trees the binary format can't hold are saved as JSON
+        return self.render_state(seq=seq)
+
+    def key_count(self):
+        return len(self.tree.inserted_keys) if self.tree else 0
+
+    def maintain(self):
+        if self.oplog.needs_compaction():
+            self.oplog.compact(self.render_snapshot)
+        else:
+            self.oplog.sync()
+
+    def close(self):
+        self.events.close()
+        if self.tree is not None and self.oplog.is_dirty():
+            self.oplog.compact(self.render_snapshot)
+        self.oplog.close()
+
+
+class TreeRegistry:
+    # memory_budget is in bytes and is compared against key_count *
+    # bytes_per_key summed over the loaded trees; idle_timeout is in seconds.
+    # log_settings are passed through to every OperationLog and
+    # event_settings to every EventBroadcaster. snapshot_format is "json" or
+    # "binary"; binary snapshots use a .snap extension.
+    def __init__(self, create_tree, tree_types, data_dir="trees", default_tree_id="default",
+                 default_paths=("tree.json", "tree.log"), memory_budget=512 * 1024 * 1024,
+                 bytes_per_key=150, idle_timeout=1800.0, delta_history=500, log_settings=None,
+                 snapshot_format="json", event_settings=None):
+        self.create_tree = create_tree
+        self.tree_types = tree_types
+        self.data_dir = data_dir
+        self.default_tree_id = default_tree_id
+        self.default_paths = default_paths
+        self.memory_budget = memory_budget
+        self.bytes_per_key = bytes_per_key
+        self.idle_timeout = idle_timeout
+        self.delta_history = delta_history
+        self.log_settings = log_settings or {}
+        self.snapshot_format = snapshot_format
+        self.event_settings = event_settings or {}
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        # Evicted sessions whose files are still being written, by tree id.
+        # They are closed outside the lock; _acquire waits on _closed rather
+        # than reload a tree from half-written files.
+        self._closing = {}
+        self._closed = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def paths_for(self, tree_id):
+        # The default tree keeps the original tree.json location
+        if tree_id == self.default_tree_id:
+            return self.default_paths
+        base = os.path.join(self.data_dir, tree_id)
+        return base + (".snap" if self.snapshot_format == "binary" else ".json"), base + ".log"
+
+    @contextmanager
+    def use(self, tree_id=None, create=False):
+        # Marks the session as in use so it can't be evicted, loading it from
+        # disk first if needed. Unknown trees are only created when create is
+        # set; the default tree always exists.
+        session = self._acquire(tree_id or self.default_tree_id, create)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.users -= 1
+                session.last_used = time.monotonic()
+
+    def _acquire(self, tree_id, create):
+        if not isinstance(tree_id, str) or not TREE_ID_PATTERN.match(tree_id):
+            raise InvalidTreeId("Invalid tree_id")
+
+        with self._lock:
+            while tree_id in self._closing:
+                self._closed.wait()
+            session = self._sessions.get(tree_id)
+            if session is None:
+                if not create and not self._exists(tree_id):
+                    raise TreeNotFound("Tree not found")
+                session = self._new_session(tree_id)
+                self._sessions[tree_id] = session
+            self._sessions.move_to_end(tree_id)
+            session.users += 1
+
+        # Loading happens outside the registry lock so one large tree doesn't
+        # hold up requests for the others
+        try:
+            session.ensure_open()
+        except Exception:
+            with self._lock:
+                session.users -= 1
+            raise
+
+        self._evict_over_budget()
+        return session
+
+    def _exists(self, tree_id):
+        if tree_id == self.default_tree_id:
+            return True
+        snapshot_path, log_path = self.paths_for(tree_id)
+        return any(os.path.exists(path) for path in (snapshot_path, log_path, log_path + ".old"))
+
+    def _new_session(self, tree_id):
+        snapshot_path, log_path = self.paths_for(tree_id)
+        directory = os.path.dirname(snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        oplog = OperationLog(snapshot_path, log_path, **self.log_settings)
+        return TreeSession(tree_id, oplog, self.create_tree, self.tree_types, self.delta_history,
+                           self.snapshot_format, self.event_settings)
+
+    def _evict_over_budget(self):
+        evicted = []
+        with self._lock:
+            used = sum(s.key_count() for s in self._sessions.values()) * self.bytes_per_key
+            for tree_id, session in list(self._sessions.items()):
+                if used <= self.memory_budget:
+                    break
+                if session.users:
+                    continue
+                used -= session.key_count() * self.bytes_per_key
+                evicted.append(self._evict(tree_id))
+        self._close_evicted(evicted)
+
+    def _evict(self, tree_id):
+        # Called with the registry lock held. The session is only detached
+        # here; compacting it can take seconds for a large tree, so it is
+        # closed by _close_evicted after the lock is released.
+        session = self._sessions.pop(tree_id)
+        self._closing[tree_id] = session
+        return session
+
+    def _close_evicted(self, sessions):
+        for session in sessions:
+            try:
+                session.close()
+            finally:
+                with self._lock:
+                    del self._closing[session.tree_id]
+                    self._closed.notify_all()
+
+    def loaded(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def start(self, poll_interval=1.0):
+        if self._thread:
+            return
+
+        with self._lock:
+            if self._thread:
+                return
+
+            self._thread = threading.Thread(target=self._run, args=(poll_interval,),
+                                            name="tree-registry", daemon=True)
+            self._thread.start()
+
+    def _run(self, poll_interval):
+        # Background maintenance: compacts or syncs each loaded log and
+        # evicts trees that have been idle longer than idle_timeout
+        while not self._stop.wait(poll_interval):
+            now = time.monotonic()
+            evicted = []
+            with self._lock:
+                for tree_id, session in list(self._sessions.items()):
+                    if not session.users and now - session.last_used >= self.idle_timeout:
+                        evicted.append(self._evict(tree_id))
+                sessions = list(self._sessions.values())
+
+            self._close_evicted(evicted)
+            for session in sessions:
+                session.maintain()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            evicted = [self._evict(tree_id) for tree_id in list(self._sessions)]
+        self._close_evicted(evicted)
@@ -0,0 +1,393 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+from engines import ENGINES
+from trees import KeyIndex, subtree_height, subtree_size
+
+# Binary tree snapshots. The JSON snapshot spells out every node as a nested
+# {"key", "left", "right"} object and repeats the keys in insertedKeys; this
+# format stores each key once, in a typed array, and the shape in two bits
+# per node:
+#
+#   header     magic, format version, key typecode, tree type, seq, node count
+#   keys       node count keys in pre-order ("q" int64 or "d" float64)
+#   order      node count uint32 pre-order positions, in insertion order
+#   structure  2 bits per node in pre-order: has left child, has right child
+#
+# All values are little-endian. The file is read through mmap, and nodes are
+# built straight from the arrays, so loading creates no intermediate objects
+# and keeps the exact shape of the saved tree.
+
+MAGIC = b"TSNP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHcx8sQQ")
+
+
+def tree_class(tree_type):
+    # The engine's plain tree class, for engines whose trees the shape alone
+    # restores (see BinarySearchTree.binary_snapshot). Red-black trees and
+    # treaps would lose their colors and priorities.
+    engine = ENGINES.get(tree_type)
+    if engine is None or not engine.tree_class.binary_snapshot:
+        raise ValueError(f"{tree_type!r} trees can't be stored as binary snapshots")
+    return engine.tree_class
+
+
+def is_binary_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def key_typecode(keys):
+    # Raises ValueError for keys the format can't hold, such as strings or a
+    # mix of ints and floats; callers fall back to JSON
+    if all(type(key) is int for key in keys):
+        if keys and (min(keys) < -2 ** 63 or max(keys) >= 2 ** 63):
+            raise ValueError("Integer keys out of int64 range")
+        return "q"
+    if all(type(key) is float for key in keys):
+        return "d"
+    raise ValueError("Keys must be all integers or all floats")
+
+
+def render_snapshot(tree, tree_type, seq):
+    # Raises ValueError like key_typecode() for trees the shape alone
+    # doesn't restore (see BinarySearchTree.binary_snapshot)
+    if not tree.binary_snapshot:
+        raise ValueError("Tree can't be saved as a binary snapshot")
+    keys = []
+    bits = []
+    stack = [tree.root] if tree.root else []
+    while stack:
+        node = stack.pop()
+        keys.append(node.key)
+        bits.append((node.left is not None, node.right is not None))
+        if node.right:
+            stack.append(node.right)
+        if node.left:
+            stack.append(node.left)
+
+    typecode = key_typecode(keys)
+    position = {key: i for i, key in enumerate(keys)}
+    order = array("I", (position[key] for key in tree.inserted_keys))
+
+    structure = bytearray((2 * len(keys) + 7) // 8)
+    for i, (has_left, has_right) in enumerate(bits):
+        if has_left:
+            structure[(2 * i) >> 3] |= 1 << ((2 * i) & 7)
+        if has_right:
+            structure[(2 * i + 1) >> 3] |= 1 << ((2 * i + 1) & 7)
+
+    key_array = array(typecode, keys)
+    if sys.byteorder == "big":
+        key_array.byteswap()
+        order.byteswap()
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, typecode.encode(), tree_type.encode(), seq, len(keys))
+    return b"".join((header, key_array.tobytes(), order.tobytes(), bytes(structure)))
+
+
+class SnapshotReader:
+    # Read-only view of a binary snapshot; use as a context manager
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("Empty snapshot file")
+
+        magic, version, typecode, tree_type, self.seq, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError("Not a binary tree snapshot")
+        self.typecode = typecode.decode()
+        self.tree_type = tree_type.rstrip(b"\0").decode()
+
+        view = memoryview(self._map)
+        keys_end = HEADER.size + 8 * self.count
+        order_end = keys_end + 4 * self.count
+        self._views = [view]
+        self.keys = self._array(view[HEADER.size:keys_end], self.typecode)
+        self.order = self._array(view[keys_end:order_end], "I")
+        self.structure = view[order_end:order_end + (2 * self.count + 7) // 8]
+        self._views.append(self.structure)
+
+    def _array(self, view, typecode):
+        if sys.byteorder == "big":
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return values
+        view = view.cast(typecode)
+        self._views.append(view)
+        return view
+
+    def inserted_keys(self):
+        keys = self.keys
+        return [keys[i] for i in self.order]
+
+    def build(self, tree):
+        # Rebuilds the saved shape into tree, which must be empty
+        keys = self.keys
+        structure = self.structure
+        nodes = []
+        pending_right = []
+        parent, is_left = None, False
+
+        for i in range(self.count):
+            node = tree._new_node(keys[i])
+            nodes.append(node)
+            if parent is None:
+                tree.root = node
+            elif is_left:
+                parent.left = node
+            else:
+                parent.right = node
+
+            bits = structure[(2 * i) >> 3] >> ((2 * i) & 7)
+            if bits & 2:
+                pending_right.append(node)
+            if bits & 1:
+                parent, is_left = node, True
+            elif pending_right:
+                parent, is_left = pending_right.pop(), False
+
+        # Children come after their parent in pre-order
+        for node in reversed(nodes):
+            node.size = 1 + subtree_size(node.left) + subtree_size(node.right)
+            node.height = 1 + max(subtree_height(node.left), subtree_height(node.right))
+
+        tree.inserted_keys = KeyIndex(self.inserted_keys())
+        return tree
+
+    def close(self):
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_header(path):
+    # The same fields read_snapshot_header() returns for JSON snapshots
+    with SnapshotReader(path) as reader:
+        return {"type": reader.tree_type, "seq": reader.seq, "insertedKeys": reader.inserted_keys()}
+
+
+def load_tree(path, tree):
+    # Rebuilds the saved shape into tree, which must be empty, from a binary
+    # or JSON snapshot
+    if is_binary_snapshot(path):
+        with SnapshotReader(path) as reader:
+            return reader.build(tree)
+
+    with open(path) as f:
+        text = f.read()
+    return build_json(text, tree)
+
+
+def build_json(text, tree):
+    # Builds a JSON snapshot's shape into tree from the node keys, without
+    # parsing the nested node objects
+    cut = text.find(', "tree": ')
+    if cut == -1:
+        return tree
+    header = json.loads(text[:cut] + "}")
+    build_preorder(tree, json_preorder_keys(text, cut))
+    tree.inserted_keys = KeyIndex(header.get("insertedKeys", []))
+    return tree
+
+
+def read_keys(path):
+    # Returns (keys in insertion order, keys in key order) from a binary or
+    # JSON snapshot of any tree type. The key order comes from walking the
+    # saved tree, so this is linear rather than a sort.
+    if is_binary_snapshot(path):
+        with SnapshotReader(path) as reader:
+            return reader.inserted_keys(), preorder_to_inorder(list(reader.keys))
+
+    with open(path) as f:
+        text = f.read()
+    cut = text.find(', "tree": ')
+    if cut == -1:
+        return [], []
+    header = json.loads(text[:cut] + "}")
+    tree_start = cut + len(', "tree": ')
+    if text.startswith('{"keys": ', tree_start):
+        # A B-tree, only a few levels deep, so json.loads is fine here
+        ordered = btree_inorder(json.JSONDecoder().raw_decode(text, tree_start)[0], [])
+    else:
+        ordered = preorder_to_inorder(json_preorder_keys(text, cut))
+    return header.get("insertedKeys", []), ordered
+
+
+def preorder_to_inorder(keys):
+    # A key is in its final place once a larger key follows it, since its
+    # left subtree has been seen by then; the stack always decreases
+    stack = []
+    ordered = []
+    for key in keys:
+        while stack and stack[-1] < key:
+            ordered.append(stack.pop())
+        stack.append(key)
+    ordered.extend(reversed(stack))
+    return ordered
+
+
+def btree_inorder(node, ordered):
+    # node is a B-tree node as to_dict() writes it
+    children = node["children"]
+    if not children:
+        ordered.extend(node["keys"])
+        return ordered
+    for child, key in zip(children, node["keys"]):
+        btree_inorder(child, ordered)
+        ordered.append(key)
+    btree_inorder(children[-1], ordered)
+    return ordered
+
+
+def json_preorder_keys(text, start=0):
+    # The node keys of a JSON tree document in pre-order, read without
+    # building the nested dicts. Quotes inside JSON strings are escaped, so
+    # the marker only matches node objects.
+    decoder = json.JSONDecoder()
+    marker = '{"key": '
+    keys = []
+    position = text.find(marker, start)
+    while position != -1:
+        key, end = decoder.raw_decode(text, position + len(marker))
+        keys.append(key)
+        position = text.find(marker, end)
+    return keys
+
+
+def build_preorder(tree, keys):
+    # A binary search tree is fixed by its keys in pre-order: each key goes
+    # left of the previous node when smaller, otherwise right of its last
+    # smaller ancestor. Every node is pushed and popped once, so this is
+    # linear.
+    nodes = []
+    stack = []
+    for key in keys:
+        node = tree._new_node(key)
+        nodes.append(node)
+        if not stack:
+            tree.root = node
+        elif key < stack[-1].key:
+            stack[-1].left = node
+        else:
+            parent = stack.pop()
+            while stack and stack[-1].key < key:
+                parent = stack.pop()
+            parent.right = node
+        stack.append(node)
+
+    # Children come after their parent in pre-order
+    for node in reversed(nodes):
+        node.size = 1 + subtree_size(node.left) + subtree_size(node.right)
+        node.height = 1 + max(subtree_height(node.left), subtree_height(node.right))
+    return tree
+
+
+# Conversion and comparison tools
+
+def tree_from_json(path):
+    # Builds the saved shape from a JSON snapshot. Returns (tree, type, seq).
+    # Raises ValueError like tree_class() for trees a binary snapshot can't
+    # hold.
+    with open(path) as f:
+        text = f.read()
+    cut = text.find(', "tree": ')
+    header = json.loads(text[:cut] + "}" if cut != -1 else text)
+
+    tree_type = header.get("type", "bst")
+    tree = build_json(text, tree_class(tree_type)())
+    return tree, tree_type, header.get("seq", 0)
+
+
+def render_json(tree, tree_type, seq):
+    return ('{"type": ' + json.dumps(tree_type) + ', "seq": ' + json.dumps(seq)
+            + ', "insertedKeys": ' + json.dumps(tree.inserted_keys.to_list())
+            + ', "tree": ' + tree.to_json() + '}')
+
+
+def to_binary(source, target):
+    tree, tree_type, seq = tree_from_json(source)
+    with open(target, "wb") as f:
+        f.write(render_snapshot(tree, tree_type, seq))
+
+
+def to_json(source, target):
+    with SnapshotReader(source) as reader:
+        tree_type, seq = reader.tree_type, reader.seq
+        tree = reader.build(tree_class(tree_type)())
+    with open(target, "w") as f:
+        f.write(render_json(tree, tree_type, seq))
+
+
+def compare(source):
+    # Sizes and load times of a JSON snapshot and its binary conversion
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, "tree.snap")
+        to_binary(source, target)
+
+        started = time.perf_counter()
+        tree_from_json(source)
+        json_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with SnapshotReader(target) as reader:
+            reader.build(tree_class(reader.tree_type)())
+        binary_seconds = time.perf_counter() - started
+
+        return {
+            "keys": reader.count,
+            "json_bytes": os.path.getsize(source),
+            "binary_bytes": os.path.getsize(target),
+            "json_load_seconds": round(json_seconds, 4),
+            "binary_load_seconds": round(binary_seconds, 4)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert and compare tree snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("to-binary", "convert a JSON snapshot to binary"),
+                            ("to-json", "convert a binary snapshot to JSON")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("source")
+        command.add_argument("target")
+    command = commands.add_parser("compare", help="compare a JSON snapshot with its binary form")
+    command.add_argument("source")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "to-binary":
+            to_binary(args.source, args.target)
+        elif args.command == "to-json":
+            to_json(args.source, args.target)
+        else:
+            result = compare(args.source)
+            print(json.dumps(result))
+    except ValueError as error:
+        parser.error(str(error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import bisect
+import os
+import random
+import tempfile
+import unittest
+
+from arena import NodeArena
+from engines import ENGINES
+from persistent import PersistentAVLTree, PersistentBST
+from redblack import RedBlackTree, is_red
+from sessions import TreeNotFound, TreeRegistry
+from treap import Treap
+from trees import AVLTree, BinarySearchTree, inorder
+
+# Randomized invariant checks for every tree engine: key order, subtree sizes
+# and heights, and each engine's own balance rule. Runs with
+# python -m unittest or pytest from the repository root.
+
+UNIVERSE = 300
+
+
+def shape(node):
+    # Nested (key, left, right) tuples
+    if node is None:
+        return None
+    return node.key, shape(node.left), shape(node.right)
+
+
+def check_binary(case, tree):
+    # Keys in order, sizes and heights consistent, inserted_keys matching
+    stack = [(tree.root, None, None)] if tree.root else []
+    order = []
+    while stack:
+        node, lo, hi = stack.pop()
+        case.assertTrue(lo is None or node.key > lo)
+        case.assertTrue(hi is None or node.key < hi)
+        left_size = node.left.size if node.left else 0
+        right_size = node.right.size if node.right else 0
+        left_height = node.left.height if node.left else 0
+        right_height = node.right.height if node.right else 0
+        case.assertEqual(node.size, 1 + left_size + right_size)
+        case.assertEqual(node.height, 1 + max(left_height, right_height))
+        order.append(node)
+        if node.left:
+            stack.append((node.left, lo, node.key))
+        if node.right:
+            stack.append((node.right, node.key, hi))
+    case.assertEqual(list(inorder(tree.root)), sorted(tree.inserted_keys))
+    return order
+
+
+def check_avl(case, tree):
+    for node in check_binary(case, tree):
+        left_height = node.left.height if node.left else 0
+        right_height = node.right.height if node.right else 0
+        case.assertLessEqual(abs(left_height - right_height), 1)
+
+
+def check_red_black(case, tree):
+    check_binary(case, tree)
+    if tree.root:
+        case.assertFalse(tree.root.red)
+
+    # Black height of every subtree, children first
+    black_height = {None: 1}
+    stack = [(tree.root, False)] if tree.root else []
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in (node.left, node.right) if child)
+            continue
+        if node.red:
+            case.assertFalse(is_red(node.left) or is_red(node.right))
+        left = black_height[node.left]
+        case.assertEqual(left, black_height[node.right])
+        black_height[node] = left + (0 if node.red else 1)
+
+
+def check_treap(case, tree):
+    for node in check_binary(case, tree):
+        for child in (node.left, node.right):
+            if child:
+                case.assertLessEqual(child.priority, node.priority)
+
+
+def check_btree(case, tree):
+    leaf_depths = set()
+    stack = [(tree.root, 0, None, None)] if tree.root else []
+    while stack:
+        node, depth, lo, hi = stack.pop()
+        case.assertLessEqual(len(node.keys), tree.max_keys)
+        if node is not tree.root:
+            case.assertGreaterEqual(len(node.keys), tree.min_keys)
+        case.assertEqual(node.keys, sorted(node.keys))
+        case.assertTrue(all((lo is None or key > lo) and (hi is None or key < hi) for key in node.keys))
+        if not node.children:
+            leaf_depths.add(depth)
+            case.assertEqual(node.size, len(node.keys))
+            continue
+        case.assertEqual(len(node.children), len(node.keys) + 1)
+        case.assertEqual(node.size, len(node.keys) + sum(child.size for child in node.children))
+        bounds = [lo] + node.keys + [hi]
+        for i, child in enumerate(node.children):
+            stack.append((child, depth + 1, bounds[i], bounds[i + 1]))
+    case.assertLessEqual(len(leaf_depths), 1)
+    case.assertEqual(list(tree.traverse("inorder")), sorted(tree.inserted_keys))
+
+
+CHECKS = {
+    "bst": check_binary,
+    "avl": check_avl,
+    "redblack": check_red_black,
+    "treap": check_treap,
+    "btree": check_btree,
+}
+
+
+def random_workload(tree, rng, steps, check=None):
+    for step in range(steps):
+        choice = rng.random()
+        key = rng.randrange(UNIVERSE)
+        if choice < 0.5:
+            tree.insert(key)
+        elif choice < 0.85:
+            tree.delete(key)
+        elif choice < 0.92:
+            tree.bulk_load(rng.sample(range(UNIVERSE), rng.randrange(30)))
+        elif choice < 0.96:
+            tree.union(rng.sample(range(UNIVERSE), rng.randrange(30)))
+        else:
+            tree.delete_range(key, key + rng.randrange(30))
+        if check and step % 25 == 0:
+            check()
+
+
+class EngineInvariantTest(unittest.TestCase):
+    def variants(self, name):
+        engine = ENGINES[name]
+        yield engine.create()
+        if engine.persistent_class:
+            yield engine.create(persistent=True)
+        if engine.arena:
+            yield engine.create(arena=True)
+        if name == "btree":
+            for order in (3, 4, 5):
+                yield engine.create(order=order)
+
+    def test_random_operations(self):
+        for name, check in CHECKS.items():
+            for trial, tree in enumerate(self.variants(name)):
+                with self.subTest(engine=name, variant=type(tree).__name__, trial=trial):
+                    rng = random.Random(trial)
+                    random_workload(tree, rng, 400, lambda: check(self, tree))
+                    check(self, tree)
+
+    def test_order_statistics(self):
+        for name in CHECKS:
+            for tree in self.variants(name):
+                with self.subTest(engine=name, variant=type(tree).__name__):
+                    random_workload(tree, random.Random(7), 300)
+                    keys = sorted(tree.inserted_keys)
+                    for index, key in enumerate(keys):
+                        self.assertEqual(tree.select(index), key)
+                    with self.assertRaises(IndexError):
+                        tree.select(len(keys))
+                    for query in range(-1, UNIVERSE + 1, 7):
+                        self.assertEqual(tree.rank(query), bisect.bisect_left(keys, query))
+                        self.assertEqual(tree.rank(query, inclusive=True), bisect.bisect_right(keys, query))
+                        self.assertEqual(tree.count_range(query, query + 20),
+                                         bisect.bisect_right(keys, query + 20) - bisect.bisect_left(keys, query))
+                        self.assertEqual(list(tree.key_range(query, query + 20)),
+                                         [key for key in keys if query <= key <= query + 20])
+                        self.assertEqual(list(tree.key_range(query, None, include_lo=False)),
+                                         [key for key in keys if key > query])
+                        self.assertEqual(tree.search(query)["found"], query in tree.inserted_keys)
+                    for order in ("preorder", "postorder", "levelorder"):
+                        self.assertEqual(sorted(tree.traverse(order)), keys)
+
+    def test_bulk_load_sizes(self):
+        for n in list(range(40)) + [1000, 4097]:
+            for name, check in CHECKS.items():
+                tree = ENGINES[name].create()
+                tree.bulk_load(range(n))
+                check(self, tree)
+
+    def test_failed_insert_leaves_tree_unchanged(self):
+        for name in CHECKS:
+            for tree in self.variants(name):
+                with self.subTest(engine=name, variant=type(tree).__name__):
+                    tree.journal = []
+                    for key in (5, 3, 8):
+                        tree.insert(key)
+                    tree.journal = []
+                    with self.assertRaises(TypeError):
+                        tree.insert("x")
+                    self.assertEqual(tree.journal, [])
+                    self.assertEqual(tree.count_range(0, 10), 3)
+                    with self.assertRaises(IndexError):
+                        tree.select(3)
+
+    def test_arena_rejects_keys_it_cannot_store(self):
+        for tree_class in (BinarySearchTree, AVLTree):
+            tree = tree_class(arena=NodeArena())
+            for key in (5, 3, 8):
+                tree.insert(key)
+            for key in (4.5, 2 ** 70, "a"):
+                with self.assertRaises(TypeError):
+                    tree.insert(key)
+            self.assertEqual(tree.root.size, 3)
+            self.assertEqual(list(tree.traverse("inorder")), [3, 5, 8])
+
+
+class PersistentTreeTest(unittest.TestCase):
+    def test_old_versions_are_untouched(self):
+        for tree_class, check in ((PersistentBST, check_binary), (PersistentAVLTree, check_avl)):
+            tree = tree_class()
+            rng = random.Random(3)
+            versions = []
+            for _ in range(300):
+                key = rng.randrange(UNIVERSE)
+                if rng.random() < 0.6:
+                    tree.insert(key)
+                else:
+                    tree.delete(key)
+                versions.append((tree.root, shape(tree.root)))
+            check(self, tree)
+            for root, saved in versions:
+                self.assertEqual(shape(root), saved)
+
+
+def replay(replica, changes):
+    # Applies journaled changes the way the UI does: plain BST inserts and
+    # deletes plus rotations by key
+    for change in changes:
+        op = change["op"]
+        if op == "insert":
+            replica.insert(change["key"])
+        elif op == "delete":
+            replica.delete(change["key"])
+        elif op == "rotate":
+            parent = None
+            node = replica.root
+            while node.key != change["key"]:
+                parent = node
+                node = node.left if change["key"] < node.key else node.right
+            if change["direction"] == "right":
+                top = replica.right_rotate(node)
+            else:
+                top = replica.left_rotate(node)
+            replica._replace_child(parent, node, top)
+
+
+class JournalReplayTest(unittest.TestCase):
+    def test_replayed_journal_gives_the_same_shape(self):
+        for tree_class in (BinarySearchTree, AVLTree, RedBlackTree, Treap, PersistentBST, PersistentAVLTree):
+            with self.subTest(tree=tree_class.__name__):
+                tree = tree_class()
+                tree.journal = []
+                replica = BinarySearchTree()
+                rng = random.Random(5)
+                for _ in range(400):
+                    key = rng.randrange(200)
+                    if rng.random() < 0.6:
+                        tree.insert(key)
+                    else:
+                        tree.delete(key)
+                    replay(replica, tree.journal)
+                    tree.journal = []
+                    self.assertEqual(shape(tree.root), shape(replica.root))
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def registry(self, snapshot_format="json"):
+        paths = (os.path.join(self.directory.name, "tree.json"), os.path.join(self.directory.name, "tree.log"))
+        return TreeRegistry(lambda tree_type: ENGINES[tree_type].create(persistent=True), list(ENGINES),
+                            data_dir=os.path.join(self.directory.name, "trees"), default_paths=paths,
+                            snapshot_format=snapshot_format)
+
+    def write(self, registry, tree_id, tree_type, keys, compact_after=None):
+        with registry.use(tree_id, create=True) as session, session.lock:
+            session.reset(tree_type)
+            for i, key in enumerate(keys):
+                if session.tree.insert(key):
+                    session.commit("insert", key=key)
+                if i == compact_after:
+                    session.oplog.compact(session.render_snapshot)
+            removed = session.tree.delete_range(10, 20)
+            if removed:
+                session.commit("delete_range", lo=10, hi=20)
+            return shape(session.tree.root) if session.tree.binary else None, sorted(session.tree.inserted_keys)
+
+    def test_trees_come_back_with_their_shape(self):
+        for snapshot_format in ("json", "binary"):
+            registry = self.registry(snapshot_format)
+            rng = random.Random(11)
+            expected = {}
+            for name in CHECKS:
+                keys = [rng.randrange(UNIVERSE) for _ in range(200)]
+                tree_id = f"{name}-{snapshot_format}"
+                expected[tree_id] = (name, self.write(registry, tree_id, name, keys, compact_after=100))
+            registry.close()
+
+            registry = self.registry(snapshot_format)
+            for tree_id, (name, (saved_shape, saved_keys)) in expected.items():
+                with self.subTest(tree=tree_id), registry.use(tree_id) as session:
+                    self.assertEqual(session.tree_type, name)
+                    self.assertEqual(sorted(session.tree.inserted_keys), saved_keys)
+                    CHECKS[name](self, session.tree)
+                    if session.tree.binary_snapshot:
+                        self.assertEqual(shape(session.tree.root), saved_shape)
+            registry.close()
+
+    def crash(self, registry, tree_id):
+        # Closing the log first leaves nothing for close() to compact, as if
+        # the process had died
+        with registry.use(tree_id) as session:
+            session.oplog.close()
+        registry.close()
+
+    def test_torn_log_write_is_ignored(self):
+        registry = self.registry()
+        _, keys = self.write(registry, "torn", "bst", [1, 2, 3, 4, 5])
+        self.crash(registry, "torn")
+        with open(os.path.join(self.directory.name, "trees", "torn.log"), "a") as f:
+            f.write('{"seq": 99, "op": "ins')
+
+        registry = self.registry()
+        with registry.use("torn") as session, session.lock:
+            self.assertEqual(sorted(session.tree.inserted_keys), keys)
+            # The degenerate chain the inserts built is kept
+            self.assertEqual(session.tree.tree_height(), 5)
+            for key in (30, 31, 32):
+                session.tree.insert(key)
+                session.commit("insert", key=key)
+        self.crash(registry, "torn")
+
+        # Records appended after the first restart survive the next one
+        registry = self.registry()
+        with registry.use("torn") as session:
+            self.assertEqual(sorted(session.tree.inserted_keys), keys + [30, 31, 32])
+            self.assertEqual(session.tree.tree_height(), 8)
+            self.assertEqual(session.oplog.seq, len(keys) + 4)
+        registry.close()
+
+    def test_unknown_trees_are_not_created_by_reads(self):
+        registry = self.registry()
+        with self.assertRaises(TreeNotFound):
+            with registry.use("missing"):
+                pass
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "trees", "missing.log")))
+        registry.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import random
+from collections import deque
+
+from trees import BinarySearchTree, TreeNode, subtree_height
+
+# Treap: a BST on the keys that is also a max-heap on a random priority
+# drawn for every node. The shape is the one inserting the keys in priority
+# order would give, so it is a random BST whatever order the keys really
+# arrive in and has expected O(log n) depth, without any balance bookkeeping.
+# An insert rotates the new node up past parents of lower priority; a delete
+# rotates the node down below its higher-priority child until it has at most
+# one child and then unlinks it.
+#
+# Priorities aren't part of the key/left/right shape, so these trees are
+# saved as JSON snapshots and rebuilt from their keys.
+
+
+class TreapNode(TreeNode):
+    __slots__ = ("priority",)
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.priority = 0.0
+
+
+class Treap(BinarySearchTree):
+    node_class = TreapNode
+    binary_snapshot = False
+
+    def __init__(self, arena=None, seed=None):
+        super().__init__(arena)
+        self.random = random.Random(seed)
+
+    def _new_node(self, key):
+        node = super()._new_node(key)
+        node.priority = self.random.random()
+        return node
+
+    def _after_insert(self, path, node):
+        rotated = False
+        while path and path[-1].priority < node.priority:
+            parent = path.pop()
+            top = self.right_rotate(parent) if node is parent.left else self.left_rotate(parent)
+            self._replace_child(path[-1] if path else None, parent, top)
+            rotated = True
+        if rotated:
+            self._refresh_heights(node.key)
+
+    def delete(self, key):
+        # The rotations that move the node down happen before it is unlinked,
+        # so they are journaled ahead of the delete itself
+        if key not in self.inserted_keys:
+            return False
+
+        self._delete_key(key)
+        self._record({"op": "delete", "key": key})
+        self.inserted_keys.discard(key)
+        return True
+
+    def _delete_key(self, key):
+        path = []
+        node = self.root
+        while node and node.key != key:
+            path.append(node)
+            node = node.left if key < node.key else node.right
+
+        self.stats.visit_search(len(path), bool(node))
+        self._trace_compare((ancestor.key for ancestor in path), node)
+        if not node:
+            return
+        self._invalidate(path)
+
+        while node.left and node.right:
+            if node.left.priority > node.right.priority:
+                top = self.right_rotate(node)
+            else:
+                top = self.left_rotate(node)
+            self._replace_child(path[-1] if path else None, node, top)
+            path.append(top)
+
+        self._replace_child(path[-1] if path else None, node, node.left or node.right)
+        self._free_node(node)
+        for ancestor in reversed(path):
+            ancestor.size -= 1
+            ancestor.height = 1 + max(subtree_height(ancestor.left), subtree_height(ancestor.right))
+
+    def bulk_load(self, keys):
+        # The rebuilt tree is balanced rather than the shape its priorities
+        # would give, so fresh priorities are handed out in level order,
+        # highest first, which keeps every parent above its children
+        added = super().bulk_load(keys)
+        if added:
+            priorities = sorted((self.random.random() for _ in range(self.root.size)), reverse=True)
+            queue = deque([self.root])
+            for priority in priorities:
+                node = queue.popleft()
+                node.priority = priority
+                if node.left:
+                    queue.append(node.left)
+                if node.right:
+                    queue.append(node.right)
+        return added
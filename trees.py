@@ -1,282 +1,969 @@
+import heapq
+import json
+from collections import deque
+from contextlib import contextmanager
+
+# to_json() caches the text of every subtree of at most this many nodes
+# whose parent's subtree is larger. Those chunks partition the lower tree, so
+# the cache holds each key's text once; re-serializing after one update
+# re-encodes a single chunk plus the few nodes above the chunks.
+JSON_CHUNK_SIZE = 256
+
 # Tree data structure classes
 class TreeNode:
+    __slots__ = ("key", "left", "right", "size", "height")
+
     def __init__(self, key):
         self.key = key
         self.left = None
         self.right = None
-        self.height = 1  # For AVL tree
+        self.size = 1  # Number of nodes in this subtree
+        self.height = 1
+
+    def copy(self):
+        node = TreeNode(self.key)
+        node.left = self.left
+        node.right = self.right
+        node.size = self.size
+        node.height = self.height
+        return node
+
+def subtree_size(node):
+    return node.size if node else 0
+
+def subtree_height(node):
+    return node.height if node else 0
+
+class TreeStats:
+    # Running totals kept by every tree. Counts are taken from path lengths
+    # after each operation rather than inside the loops, so keeping them
+    # costs a few additions per operation.
+    __slots__ = ("rotations", "comparisons", "nodes_visited")
 
-class BinarySearchTree:
     def __init__(self):
+        self.rotations = 0
+        self.comparisons = 0
+        self.nodes_visited = 0
+
+    def visit(self, nodes, comparisons):
+        self.nodes_visited += nodes
+        self.comparisons += comparisons
+
+    def visit_search(self, depth, found):
+        # Lookups compare the key with == and < at every node they pass and
+        # stop after one == on the node that matches
+        self.visit(depth + found, 2 * depth + found)
+
+class KeyIndex:
+    # Insertion-ordered set of keys: dict lookups make add, remove and
+    # membership O(1) while iteration still follows insertion order
+    def __init__(self, keys=()):
+        self._keys = dict.fromkeys(keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def update(self, keys):
+        self._keys.update(dict.fromkeys(keys))
+
+    def discard(self, key):
+        self._keys.pop(key, None)
+
+    def clear(self):
+        self._keys.clear()
+
+    def to_list(self):
+        return list(self._keys)
+
+class BinarySearchTree:
+    node_class = TreeNode
+    # True when nodes reachable from a published root are never modified
+    persistent = False
+    # Nodes have key, left and right, so /layout, /tree/window and the UI
+    # can draw the tree
+    binary = True
+    # The key/left/right shape is all there is to the tree, so a binary
+    # snapshot (see snapshot.py) restores it exactly. Trees that keep more
+    # per node, like red-black colors, are saved as JSON.
+    binary_snapshot = True
+
+    def __init__(self, arena=None):
         self.root = None
-        self.inserted_keys = []
+        self.inserted_keys = KeyIndex()
+        # Set to a list to have mutations record what they changed
+        self.journal = None
+        # Set to a list to have insert and delete record the steps they took:
+        # keys compared, where a new key was attached, successor swaps and
+        # rotations. Used to animate single operations.
+        self.trace = None
+        self.stats = TreeStats()
+        # Nodes are node_class instances unless an arena.NodeArena is given,
+        # in which case they live in its typed arrays
+        self.arena = arena
+        # Chunk root -> JSON text, see to_json()
+        self._json_cache = {}
     
     def insert(self, key):
         if key in self.inserted_keys:
             return False  # Prevent duplicate keys
             
-        self.root = self._insert_recursive(self.root, key)
-        self.inserted_keys.append(key)
+        self._check_keys((key,))
+        with self._recording({"op": "insert", "key": key}):
+            self._insert_key(key)
+        self.inserted_keys.add(key)
         return True
+
+    def _record(self, change):
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def _check_keys(self, keys):
+        if self.arena is not None:
+            self.arena.check_keys(keys)
+
+    @contextmanager
+    def _recording(self, change):
+        # Journals change ahead of whatever the mutation records itself (its
+        # rotations), and takes all of it back out if the mutation raises,
+        # e.g. on a key that can't be compared with the tree's keys
+        journal = self.journal
+        mark = len(journal) if journal is not None else 0
+        self._record(change)
+        try:
+            yield
+        except Exception:
+            if journal is not None:
+                del journal[mark:]
+            raise
+
+    def _trace(self, step):
+        if self.trace is not None:
+            self.trace.append(step)
+
+    def _trace_compare(self, keys, found=None):
+        # found is the matching node, compared last
+        if self.trace is not None:
+            keys = list(keys)
+            if found is not None:
+                keys.append(found.key)
+            self.trace.append({"op": "compare", "keys": keys})
+
+    def _trace_insert(self, key, keys):
+        # keys are the keys compared on the way down; the last one is the
+        # new node's parent
+        if self.trace is not None:
+            keys = list(keys)
+            parent = keys[-1] if keys else None
+            side = None if parent is None else "left" if key < parent else "right"
+            self.trace.append({"op": "compare", "keys": keys})
+            self.trace.append({"op": "attach", "key": key, "parent": parent, "side": side})
+
+    def _trace_successor(self, key, keys):
+        # keys run from the deleted node's right child down to its successor
+        if self.trace is not None:
+            self.trace.append({"op": "successor", "key": key, "successor": keys[-1], "keys": keys})
     
-    def _insert_recursive(self, root, key):
-        if not root:
-            return TreeNode(key)
-        
-        if key < root.key:
-            root.left = self._insert_recursive(root.left, key)
-        elif key > root.key:
-            root.right = self._insert_recursive(root.right, key)
-        
-        return root
+    def _insert_key(self, key):
+        new_node = self._new_node(key)
+        if not self.root:
+            self._trace_insert(key, ())
+            self.root = new_node
+            self._after_insert([], new_node)
+            return
+
+        # Sizes change only once the whole path is known, so a key that
+        # can't be compared leaves the tree as it was. The key is known to be
+        # new, so every node passed gains a descendant.
+        path = []
+        current = self.root
+        while current:
+            path.append(current)
+            current = current.left if key < current.key else current.right
+        for node in path:
+            node.size += 1
+        self.stats.visit(len(path), len(path))
+        self._invalidate(path)
+        self._trace_insert(key, (node.key for node in path))
+
+        parent = path[-1]
+        if key < parent.key:
+            parent.left = new_node
+        else:
+            parent.right = new_node
+
+        # Heights grow bottom-up until a node already was tall enough
+        for depth in range(len(path) - 1, -1, -1):
+            height = len(path) - depth + 1
+            if path[depth].height >= height:
+                break
+            path[depth].height = height
+        self._after_insert(path, new_node)
+
+    def _after_insert(self, path, node):
+        # Called once node is linked in below path (root first) with sizes
+        # and heights updated; balanced subclasses restore their invariants
+        # here
+        pass
     
+    def bulk_load(self, keys):
+        # Sort and dedupe the new keys, merge them with the keys already in
+        # the tree and rebuild it balanced in one pass. Returns the keys that
+        # were actually added, in input order.
+        added = [key for key in dict.fromkeys(keys) if key not in self.inserted_keys]
+        if not added:
+            return []
+
+        self._check_keys(added)
+        merged = sorted(added)
+        if self.root:
+            merged = list(heapq.merge(inorder(self.root), merged))
+        self.stats.visit(len(merged), 0)
+        self._json_cache = {}
+        if self.arena is not None:
+            self.arena.clear()
+        self.root = self._build_balanced(merged)
+        self.inserted_keys.update(added)
+        self._record({"op": "rebuild"})
+        return added
+
+    def _build_balanced(self, sorted_keys):
+        # The middle key of every range becomes the subtree root, so each
+        # node is created exactly once. A range of n keys always ends up
+        # with height n.bit_length().
+        if not sorted_keys:
+            return None
+
+        root = None
+        stack = [(0, len(sorted_keys), None, False)]
+        while stack:
+            lo, hi, parent, is_left = stack.pop()
+            mid = (lo + hi) // 2
+            node = self._new_node(sorted_keys[mid])
+            node.size = hi - lo
+            node.height = (hi - lo).bit_length()
+
+            if not parent:
+                root = node
+            elif is_left:
+                parent.left = node
+            else:
+                parent.right = node
+
+            if lo < mid:
+                stack.append((lo, mid, node, True))
+            if mid + 1 < hi:
+                stack.append((mid + 1, hi, node, False))
+        return root
+
     def search(self, key):
-        return self._search_recursive(self.root, key)
-    
-    def _search_recursive(self, root, key, level=0, parent=None, path=None):
-        if path is None:
-            path = []
-        if not root:
-            return {"found": False, "key": key, "path": path}
-
-        path.append(root.key)
-
-        if key == root.key:
-            return {
-                "found": True,
-                "key": key,
-                "level": level,
-                "parent": parent.key if parent else "None",
-                "path": path
-            }
-
-        if key < root.key:
-            return self._search_recursive(root.left, key, level + 1, root, path)
-        return self._search_recursive(root.right, key, level + 1, root, path)
+        path = []
+        parent = None
+        current = self.root
+        level = 0
+
+        while current:
+            path.append(current.key)
+
+            if key == current.key:
+                self.stats.visit_search(level, True)
+                return {
+                    "found": True,
+                    "key": key,
+                    "level": level,
+                    "parent": parent.key if parent else "None",
+                    "path": path
+                }
+
+            parent = current
+            current = current.left if key < current.key else current.right
+            level += 1
+
+        self.stats.visit_search(level, False)
+        return {"found": False, "key": key, "path": path}
     
+    def rank(self, key, inclusive=False):
+        return rank(self.root, key, inclusive)
+
+    def select(self, index):
+        return select(self.root, index)
+
+    def count_range(self, lo, hi):
+        return count_range(self.root, lo, hi)
+
+    def key_range(self, lo=None, hi=None, include_lo=True):
+        return key_range(self.root, lo, hi, include_lo)
+
+    def traverse(self, order):
+        # Lazy traversal starting from the current root, which persistent
+        # trees never change however long it is consumed. Raises KeyError
+        # for unknown orders.
+        return TRAVERSALS[order](self.root)
+
+    def key_depths(self):
+        # (key, depth) pairs in key order, depth 0 at the root
+        return inorder_depths(self.root)
+
+    def tree_height(self):
+        return subtree_height(self.root)
+
+    def delete_range(self, lo, hi):
+        # Removes every key in [lo, hi] and returns them in order. A plain
+        # BST deletes them one at a time so it keeps the shape those deletes
+        # give; AVLTree cuts the whole range out with split and join.
+        keys = list(key_range(self.root, lo, hi))
+        for key in keys:
+            self.delete(key)
+        return keys
+
+    def union(self, keys):
+        # Adds the keys of another tree (or any iterable) that aren't here
+        # yet and returns them. A plain BST is rebuilt like bulk_load;
+        # AVLTree joins them in.
+        return self.bulk_load(keys)
+
     def delete(self, key):
         if key not in self.inserted_keys:
             return False
             
-        self.root = self._delete_recursive(self.root, key)
-        if key in self.inserted_keys:
-            self.inserted_keys.remove(key)
+        with self._recording({"op": "delete", "key": key}):
+            self._delete_key(key)
+        self.inserted_keys.discard(key)
         return True
     
-    def _delete_recursive(self, root, key):
-        if not root:
-            return None
-        
-        if key < root.key:
-            root.left = self._delete_recursive(root.left, key)
-        elif key > root.key:
-            root.right = self._delete_recursive(root.right, key)
+    def _delete_key(self, key):
+        ancestors = []
+        current = self.root
+        while current and current.key != key:
+            ancestors.append(current)
+            current = current.left if key < current.key else current.right
+
+        self.stats.visit_search(len(ancestors), bool(current))
+        self._trace_compare((node.key for node in ancestors), current)
+        if not current:
+            return
+
+        # Node with two children: copy the in-order successor's key and
+        # unlink the successor instead
+        if current.left and current.right:
+            depth = len(ancestors)
+            ancestors.append(current)
+            successor = current.right
+            while successor.left:
+                ancestors.append(successor)
+                successor = successor.left
+            self.stats.visit(len(ancestors) - depth, 0)
+            self._trace_successor(current.key, [node.key for node in ancestors[depth + 1:]] + [successor.key])
+            current.key = successor.key
+            current = successor
+        self._invalidate(ancestors)
+
+        # Node with only one child or no child
+        child = current.left or current.right
+        self._replace_child(ancestors[-1] if ancestors else None, current, child)
+        self._free_node(current)
+        for node in reversed(ancestors):
+            node.size -= 1
+            node.height = 1 + max(subtree_height(node.left), subtree_height(node.right))
+        self._after_delete(ancestors, current, child)
+
+    def _after_delete(self, ancestors, removed, child):
+        # Called once removed has been unlinked and child put in its place
+        # below ancestors (root first), with sizes and heights updated
+        pass
+
+    def _new_node(self, key):
+        if self.arena is not None:
+            return self.arena.new_node(key)
+        return self.node_class(key)
+
+    def _free_node(self, node):
+        self._json_cache.pop(node, None)
+        if self.arena is not None:
+            self.arena.free(node)
+
+    def _invalidate(self, nodes):
+        # Drops the cached JSON of subtrees that are about to change in place.
+        # Any change happens below one of the nodes on its search path, so
+        # whichever chunk holds it is rooted on that path.
+        if self._json_cache:
+            for node in nodes:
+                self._json_cache.pop(node, None)
+
+    def _replace_child(self, parent, old, new):
+        # Nodes are compared with == so arena handles (which are created on
+        # every access) match; plain nodes still compare by identity
+        if not parent:
+            self.root = new
+        elif parent.left == old:
+            parent.left = new
         else:
-            # Node with only one child or no child
-            if not root.left:
-                return root.right
-            elif not root.right:
-                return root.left
-            
-            # Node with two children
-            successor = self._find_min(root.right)
-            root.key = successor.key
-            root.right = self._delete_recursive(root.right, successor.key)
-        
-        return root
-    
-    def _find_min(self, root):
-        current = root
-        while current.left:
-            current = current.left
-        return current
+            parent.right = new
     
-    def to_dict(self):
-        return self._to_dict_recursive(self.root)
-    
-    def _to_dict_recursive(self, node):
-        if not node:
-            return None
-        
-        return {
-            "key": node.key,
-            "left": self._to_dict_recursive(node.left),
-            "right": self._to_dict_recursive(node.right)
-        }
-
-class AVLNode:
-    def __init__(self, key):
-        self.key = key
-        self.left = None
-        self.right = None
-        self.height = 1
-
-class AVLTree:
-    def __init__(self):
-        self.root = None
-        self.inserted_keys = []
-
-    def height(self, node):
-        return node.height if node else 0
-
-    def get_balance(self, node):
-        return self.height(node.left) - self.height(node.right) if node else 0
-
     def right_rotate(self, y):
+        change = {"op": "rotate", "key": y.key, "direction": "right"}
+        self._record(change)
+        self._trace(change)
+        self.stats.rotations += 1
         x = y.left
         T2 = x.right
+        self._invalidate((x, y))
 
         x.right = y
         y.left = T2
 
-        y.height = 1 + max(self.height(y.left), self.height(y.right))
-        x.height = 1 + max(self.height(x.left), self.height(x.right))
+        y.height = 1 + max(subtree_height(y.left), subtree_height(y.right))
+        x.height = 1 + max(subtree_height(x.left), subtree_height(x.right))
+        y.size = 1 + subtree_size(y.left) + subtree_size(y.right)
+        x.size = 1 + subtree_size(x.left) + subtree_size(x.right)
 
         return x
 
     def left_rotate(self, x):
+        change = {"op": "rotate", "key": x.key, "direction": "left"}
+        self._record(change)
+        self._trace(change)
+        self.stats.rotations += 1
         y = x.right
         T2 = y.left
+        self._invalidate((x, y))
 
         y.left = x
         x.right = T2
 
-        x.height = 1 + max(self.height(x.left), self.height(x.right))
-        y.height = 1 + max(self.height(y.left), self.height(y.right))
+        x.height = 1 + max(subtree_height(x.left), subtree_height(x.right))
+        y.height = 1 + max(subtree_height(y.left), subtree_height(y.right))
+        x.size = 1 + subtree_size(x.left) + subtree_size(x.right)
+        y.size = 1 + subtree_size(y.left) + subtree_size(y.right)
 
         return y
 
-    def insert(self, key):
-        if key in self.inserted_keys:
-            return False  # Prevent duplicate keys
-        self.root = self._insert(self.root, key)
-        self.inserted_keys.append(key)
-        return True
+    def _refresh_heights(self, key):
+        # Recomputes heights bottom-up along the search path for key (going
+        # right on equal keys, where a deleted node's successor came from).
+        # Rotations fix the heights of the nodes they move but not of the
+        # nodes above them, which are all on this path.
+        path = []
+        node = self.root
+        while node:
+            path.append(node)
+            node = node.left if key < node.key else node.right
+        for node in reversed(path):
+            node.height = 1 + max(subtree_height(node.left), subtree_height(node.right))
 
-    def _insert(self, node, key):
-        if not node:
-            return AVLNode(key)
+    def to_dict(self):
+        root = self.root
+        if not root:
+            return None
 
-        if key < node.key:
-            node.left = self._insert(node.left, key)
-        elif key > node.key:
-            node.right = self._insert(node.right, key)
+        result = {"key": root.key, "left": None, "right": None}
+        stack = [(root, result)]
+        while stack:
+            node, data = stack.pop()
+            if node.left:
+                data["left"] = {"key": node.left.key, "left": None, "right": None}
+                stack.append((node.left, data["left"]))
+            if node.right:
+                data["right"] = {"key": node.right.key, "left": None, "right": None}
+                stack.append((node.right, data["right"]))
+        return result
+
+    def to_json(self):
+        # Same document as json.dumps(self.to_dict()), written without
+        # recursion so degenerate trees deeper than the recursion limit
+        # can still be saved. Chunks (see JSON_CHUNK_SIZE) come from the cache
+        # when their subtree hasn't changed; the cache keeps only the chunks
+        # this call used, so replaced nodes don't pile up in it.
+        cache = self._json_cache
+        used = {}
+        parts = []
+        stack = [self.root]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif item is None:
+                parts.append("null")
+            elif item.size <= JSON_CHUNK_SIZE:
+                text = cache.get(item)
+                if text is None:
+                    text = encode_subtree(item)
+                used[item] = text
+                parts.append(text)
+            else:
+                parts.append('{"key": ' + json.dumps(item.key) + ', "left": ')
+                stack.append("}")
+                stack.append(item.right)
+                stack.append(', "right": ')
+                stack.append(item.left)
+        self._json_cache = used
+        return "".join(parts)
+
+def encode_subtree(node):
+    parts = []
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+        elif item is None:
+            parts.append("null")
         else:
-            return node  # No duplicates
-
-        node.height = 1 + max(self.height(node.left), self.height(node.right))
-
-        balance = self.get_balance(node)
-
-        # LL
-        if balance > 1 and key < node.left.key:
-            return self.right_rotate(node)
-
-        # RR
-        if balance < -1 and key > node.right.key:
-            return self.left_rotate(node)
-
-        # LR
-        if balance > 1 and key > node.left.key:
-            node.left = self.left_rotate(node.left)
-            return self.right_rotate(node)
+            parts.append('{"key": ' + json.dumps(item.key) + ', "left": ')
+            stack.append("}")
+            stack.append(item.right)
+            stack.append(', "right": ')
+            stack.append(item.left)
+    return "".join(parts)
+
+class AVLTree(BinarySearchTree):
+    def height(self, node):
+        return node.height if node else 0
 
-        # RL
-        if balance < -1 and key < node.right.key:
-            node.right = self.right_rotate(node.right)
-            return self.left_rotate(node)
+    def get_balance(self, node):
+        return self.height(node.left) - self.height(node.right) if node else 0
 
+    def _insert_key(self, key):
+        # Walked before any size changes, like BinarySearchTree._insert_key
+        path = []
+        current = self.root
+        while current:
+            path.append(current)
+            current = current.left if key < current.key else current.right
+        for node in path:
+            node.size += 1
+        self.stats.visit(len(path), len(path))
+        self._invalidate(path)
+        self._trace_insert(key, (node.key for node in path))
+
+        new_node = self._new_node(key)
+        if not path:
+            self.root = new_node
+            return
+
+        parent = path[-1]
+        if key < parent.key:
+            parent.left = new_node
+        else:
+            parent.right = new_node
+        self._rebalance_path(path)
+
+    # Join-based operations. _join(left, node, right) builds a balanced tree
+    # out of two AVL trees and a middle node in O(|height(left) -
+    # height(right)|) by walking down the taller tree's spine to a subtree of
+    # the other's height. split and delete_range need O(log n) joins whose
+    # costs telescope to O(log n) in total, and union of m keys into n costs
+    # O(m log(n / m + 1)) rather than m separate inserts. Their rotations
+    # are not journaled one by one: each operation publishes a single
+    # "rebuild" change.
+
+    def split(self, key):
+        # Splits this tree into two new trees, with the keys below key and
+        # the keys from key up; this tree is left empty. Arena nodes can't
+        # move between trees, so arena-backed trees can't be split.
+        if self.arena is not None:
+            raise ValueError("Arena-backed trees can't be split")
+        lower, upper = type(self)(), type(self)()
+        with self._unjournaled():
+            left, found, right = self._split(self.root, key)
+            if found:
+                right = self._join(None, found, right)
+        lower.root, upper.root = left, right
+
+        for tree in (lower, upper):
+            tree.inserted_keys = KeyIndex(inorder(tree.root))
+        self.root = None
+        self.inserted_keys = KeyIndex()
+        self._json_cache = {}
+        self._record({"op": "rebuild"})
+        return lower, upper
+
+    @classmethod
+    def join(cls, left, right):
+        # Returns a new tree holding both trees' nodes; every key of left
+        # must be smaller than every key of right. Both inputs are left empty.
+        if left.arena is not None or right.arena is not None:
+            raise ValueError("Arena-backed trees can't be joined")
+        if left.root and right.root and _max_key(left.root) >= _min_key(right.root):
+            raise ValueError("Every key of left must be smaller than every key of right")
+        tree = cls()
+        tree.root = tree._concat(left.root, right.root)
+        tree.inserted_keys = KeyIndex(left.inserted_keys)
+        tree.inserted_keys.update(right.inserted_keys)
+        for source in (left, right):
+            source.root = None
+            source.inserted_keys = KeyIndex()
+            source._json_cache = {}
+        return tree
+
+    def delete_range(self, lo, hi):
+        if self.root is None or hi < lo:
+            return []
+        with self._unjournaled():
+            left, lo_node, rest = self._split(self.root, lo)
+            middle, hi_node, right = self._split(rest, hi)
+            self.root = self._concat(left, right)
+
+        # Everything removed has to leave the key index (and the arena), so
+        # this part is linear in the number of keys removed
+        removed = []
+        if lo_node:
+            removed.append(lo_node)
+        removed.extend(_inorder_nodes(middle))
+        if hi_node:
+            removed.append(hi_node)
+        keys = [node.key for node in removed]
+        for node in removed:
+            self._free_node(node)
+        for key in keys:
+            self.inserted_keys.discard(key)
+        if keys:
+            self._record({"op": "rebuild"})
+        return keys
+
+    def union(self, keys):
+        added = sorted(key for key in dict.fromkeys(keys) if key not in self.inserted_keys)
+        if not added:
+            return []
+        self._check_keys(added)
+        with self._unjournaled():
+            self.root = self._union(self.root, self._build_balanced(added))
+        self.inserted_keys.update(added)
+        self._record({"op": "rebuild"})
+        return added
+
+    @contextmanager
+    def _unjournaled(self):
+        journal, self.journal = self.journal, None
+        try:
+            yield
+        finally:
+            self.journal = journal
+
+    def _link(self, node, left, right):
+        # Hangs left and right under node and recomputes its size and height
+        self._invalidate((node,))
+        node.left = left
+        node.right = right
+        node.size = 1 + subtree_size(left) + subtree_size(right)
+        node.height = 1 + max(subtree_height(left), subtree_height(right))
         return node
 
-    def search(self, key):
-        return self._search_recursive(self.root, key)
-
-    def _search_recursive(self, root, key, level=0, parent=None, path=None):
-        if path is None:
-            path = []
-        if not root:
-            return {"found": False, "key": key, "path": path}
-
-        path.append(root.key)
-
-        if key == root.key:
-            return {
-                "found": True,
-                "key": key,
-                "level": level,
-                "parent": parent.key if parent else "None",
-                "path": path
-            }
-
-        if key < root.key:
-            return self._search_recursive(root.left, key, level + 1, root, path)
-        return self._search_recursive(root.right, key, level + 1, root, path)
-
-        
-    def delete(self, key):
-        if key not in self.inserted_keys:
-            return False
-        self.root = self._delete(self.root, key)
-        self.inserted_keys.remove(key)
-        return True
-
-    def _delete(self, node, key):
-        if not node:
-            return node
-
-        if key < node.key:
-            node.left = self._delete(node.left, key)
-        elif key > node.key:
-            node.right = self._delete(node.right, key)
+    def _join(self, left, node, right):
+        if subtree_height(left) > subtree_height(right) + 1:
+            return self._join_right(left, node, right)
+        if subtree_height(right) > subtree_height(left) + 1:
+            return self._join_left(left, node, right)
+        return self._link(node, left, right)
+
+    def _join_right(self, left, node, right):
+        # left is the taller tree: follow its right spine down to a subtree
+        # no more than one level taller than right, join there and rebalance
+        # on the way back up
+        child = left.right
+        if subtree_height(child) <= subtree_height(right) + 1:
+            joined = self._link(node, child, right)
         else:
-            if not node.left:
-                return node.right
-            elif not node.right:
-                return node.left
-
-            temp = self._find_min(node.right)
-            node.key = temp.key
-            node.right = self._delete(node.right, temp.key)
-
-        node.height = 1 + max(self.height(node.left), self.height(node.right))
+            joined = self._join_right(child, node, right)
+        return self._rebalance(self._link(left, left.left, joined))
 
+    def _join_left(self, left, node, right):
+        child = right.left
+        if subtree_height(child) <= subtree_height(left) + 1:
+            joined = self._link(node, left, child)
+        else:
+            joined = self._join_left(left, node, child)
+        return self._rebalance(self._link(right, joined, right.right))
+
+    def _split(self, node, key):
+        # Returns (keys < key, node holding key or None, keys > key). Every
+        # level joins one subtree onto the side it belongs to.
+        if node is None:
+            return None, None, None
+        if key == node.key:
+            return node.left, node, node.right
+        if key < node.key:
+            left, found, right = self._split(node.left, key)
+            return left, found, self._join(right, node, node.right)
+        left, found, right = self._split(node.right, key)
+        return self._join(node.left, node, left), found, right
+
+    def _split_min(self, node):
+        # Returns (node without its smallest key, the node that held it)
+        if node.left is None:
+            return node.right, node
+        rest, smallest = self._split_min(node.left)
+        return self._join(rest, node, node.right), smallest
+
+    def _concat(self, left, right):
+        # Joins two trees without a middle node
+        if right is None:
+            return left
+        rest, smallest = self._split_min(right)
+        return self._join(left, smallest, rest)
+
+    def _union(self, a, b):
+        # Both trees are consumed; keys are assumed distinct
+        if a is None:
+            return b
+        if b is None:
+            return a
+        left, _, right = self._split(a, b.key)
+        return self._join(self._union(left, b.left), b, self._union(right, b.right))
+
+    def _delete_key(self, key):
+        path = []
+        current = self.root
+        while current and current.key != key:
+            path.append(current)
+            current = current.left if key < current.key else current.right
+
+        self.stats.visit_search(len(path), bool(current))
+        self._trace_compare((node.key for node in path), current)
+        if not current:
+            return
+
+        if current.left and current.right:
+            depth = len(path)
+            path.append(current)
+            successor = current.right
+            while successor.left:
+                path.append(successor)
+                successor = successor.left
+            self.stats.visit(len(path) - depth, 0)
+            self._trace_successor(current.key, [node.key for node in path[depth + 1:]] + [successor.key])
+            current.key = successor.key
+            current = successor
+        self._invalidate(path)
+
+        self._replace_child(path[-1] if path else None, current, current.left or current.right)
+        self._free_node(current)
+        for node in path:
+            node.size -= 1
+        self._rebalance_path(path)
+
+    def _rebalance_path(self, path):
+        # Walk back up from the changed leaf, fixing heights and rotating
+        # where needed. Once a subtree keeps its old height nothing above
+        # it can change, so the walk stops there. Sizes along the path have
+        # already been adjusted by the caller.
+        for i in range(len(path) - 1, -1, -1):
+            node = path[i]
+            old_height = node.height
+            node.height = 1 + max(self.height(node.left), self.height(node.right))
+
+            subtree = self._rebalance(node)
+            if subtree != node:
+                self._replace_child(path[i - 1] if i else None, node, subtree)
+
+            if subtree.height == old_height:
+                break
+
+    def _rebalance(self, node):
         balance = self.get_balance(node)
 
         # LL
         if balance > 1 and self.get_balance(node.left) >= 0:
+            self._trace({"op": "rebalance", "case": "LL", "key": node.key})
             return self.right_rotate(node)
 
         # RR
         if balance < -1 and self.get_balance(node.right) <= 0:
+            self._trace({"op": "rebalance", "case": "RR", "key": node.key})
             return self.left_rotate(node)
 
         # LR
         if balance > 1 and self.get_balance(node.left) < 0:
+            self._trace({"op": "rebalance", "case": "LR", "key": node.key})
             node.left = self.left_rotate(node.left)
             return self.right_rotate(node)
 
         # RL
         if balance < -1 and self.get_balance(node.right) > 0:
+            self._trace({"op": "rebalance", "case": "RL", "key": node.key})
             node.right = self.right_rotate(node.right)
             return self.left_rotate(node)
 
         return node
 
-    def _find_min(self, node):
-        current = node
-        while current.left:
-            current = current.left
-        return current
-
-    def to_dict(self):
-        return self._to_dict_recursive(self.root)
-
-    def _to_dict_recursive(self, node):
-        if not node:
-            return None
-        
-        return {
-            "key": node.key,
-            "left": self._to_dict_recursive(node.left),
-            "right": self._to_dict_recursive(node.right)
-        }
\ No newline at end of file
+def _min_key(node):
+    while node.left:
+        node = node.left
+    return node.key
+
+def _max_key(node):
+    while node.right:
+        node = node.right
+    return node.key
+
+def inorder_depths(node):
+    # In-order (key, depth) pairs, depth 0 at node
+    stack = []
+    depth = 0
+    while stack or node:
+        while node:
+            stack.append((node, depth))
+            node, depth = node.left, depth + 1
+        node, depth = stack.pop()
+        yield node.key, depth
+        node, depth = node.right, depth + 1
+
+def _inorder_nodes(node):
+    stack = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
+
+# Lazy traversals. The depth-first orders keep only the current root-to-node
+# path on their stack, so memory is O(height) and keys are produced as soon
+# as they are reached.
+def inorder(node):
+    stack = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node.key
+        node = node.right
+
+def key_range(node, lo=None, hi=None, include_lo=True):
+    # In-order walk limited to lo <= key <= hi (lo < key when include_lo is
+    # false; a missing bound is open). Subtrees entirely below lo are never
+    # pushed and the walk stops at the first key above hi, so yielding k keys
+    # costs O(height + k).
+    stack = []
+    while stack or node:
+        while node:
+            if lo is not None and (node.key < lo or (node.key == lo and not include_lo)):
+                node = node.right
+            else:
+                stack.append(node)
+                node = node.left
+        if not stack:
+            return
+        node = stack.pop()
+        if hi is not None and node.key > hi:
+            return
+        yield node.key
+        node = node.right
+
+def preorder(node):
+    stack = [node] if node else []
+    while stack:
+        node = stack.pop()
+        yield node.key
+        if node.right:
+            stack.append(node.right)
+        if node.left:
+            stack.append(node.left)
+
+def postorder(node):
+    stack = []
+    last = None
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        top = stack[-1]
+        if top.right and top.right != last:
+            node = top.right
+        else:
+            yield top.key
+            last = stack.pop()
+
+def level_order(node):
+    # Breadth-first has to hold one level of the tree in its queue; bounding
+    # it to O(height) would mean re-walking the tree once per level
+    queue = deque([node]) if node else deque()
+    while queue:
+        current = queue.popleft()
+        yield current.key
+        if current.left:
+            queue.append(current.left)
+        if current.right:
+            queue.append(current.right)
+
+def find_node(node, key):
+    while node and node.key != key:
+        node = node.left if key < node.key else node.right
+    return node
+
+def window(node, depth):
+    # The subtree under node cut off depth levels below it, in the to_dict
+    # shape plus each node's size and height. Children past the cut are
+    # stubs marked "truncated" so a client can ask for them separately.
+    if not node:
+        return None
+
+    def entry(node):
+        return {"key": node.key, "size": node.size, "height": node.height}
+
+    result = entry(node)
+    stack = [(node, result, 0)]
+    while stack:
+        node, data, level = stack.pop()
+        for side in ("left", "right"):
+            child = getattr(node, side)
+            if not child:
+                data[side] = None
+                continue
+            data[side] = entry(child)
+            if level < depth:
+                stack.append((child, data[side], level + 1))
+            else:
+                data[side]["truncated"] = True
+    return result
+
+# Order statistics, answered from subtree sizes in O(height)
+def rank(node, key, inclusive=False):
+    # Number of keys smaller than key (or equal to it, when inclusive)
+    count = 0
+    while node:
+        if key < node.key or (key == node.key and not inclusive):
+            if key == node.key:
+                return count + subtree_size(node.left)
+            node = node.left
+        else:
+            count += subtree_size(node.left) + 1
+            node = node.right
+    return count
+
+def select(node, index):
+    # Key at the given 0-based in-order position
+    if index < 0 or index >= subtree_size(node):
+        raise IndexError("Index out of range")
+    while True:
+        left_size = subtree_size(node.left)
+        if index < left_size:
+            node = node.left
+        elif index == left_size:
+            return node.key
+        else:
+            index -= left_size + 1
+            node = node.right
+
+def count_range(node, lo, hi):
+    # Number of keys k with lo <= k <= hi
+    if hi < lo:
+        return 0
+    return rank(node, hi, inclusive=True) - rank(node, lo)
+
+TRAVERSALS = {
+    "inorder": inorder,
+    "preorder": preorder,
+    "postorder": postorder,
+    "levelorder": level_order
+}